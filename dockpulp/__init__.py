@@ -15,7 +15,9 @@
 
 import six
 import atexit
-from datetime import datetime
+import copy
+from datetime import datetime, timedelta
+from six.moves import BaseHTTPServer
 from six.moves import configparser
 from six.moves import zip_longest
 import hashlib
@@ -28,6 +30,7 @@ import shutil
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import warnings
 try:
@@ -36,13 +39,14 @@ try:
 except ImportError:
     gnupg = None
     import subprocess
+from collections import OrderedDict
 from contextlib import closing
 from distutils.version import LooseVersion
 from six.moves.urllib.parse import urlparse
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from operator import itemgetter
-import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 try:
     # Python 2.6 and earlier
@@ -71,6 +75,9 @@ DEFAULT_DISTRIBUTORS_FILE = '/etc/dockpulpdistributors.json'
 DEFAULT_DISTRIBUTIONS_FILE = '/etc/dockpulpdistributions.json'
 PREFIX = 'redhat-'
 ORIGIN_PREFIX = 'origin-'
+TASK_END_STATES = ('finished', 'error', 'skipped', 'canceled')
+# Pulp 2 only sends events for repository syncs and publishes
+TASK_EVENT_TYPES = ['repo.sync.finish', 'repo.publish.finish']
 BATCH_SIZE = os.environ.get("DOCKPULP_BATCH_SIZE", 10000)
 
 
@@ -112,6 +119,365 @@ def grouper(iterable, n, fillvalue=None):
     return list(zip_longest(*args, fillvalue=fillvalue))
 
 
+def parse_timestamp(value):
+    """Parse a UTC timestamp as Pulp reports it into a naive datetime.
+
+    None and empty values are returned as None.
+    """
+    if not value:
+        return None
+    value = re.sub(r'(Z|[+-]00:?00)$', '', value)
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Unknown timestamp format: %s' % value)
+
+
+class ChunkReader(object):
+    """Read a file object in chunks into a single reusable buffer.
+
+    Each chunk is a memoryview of the same bytearray, so uploading does not
+    allocate a new object per chunk and the memory used stays at one chunk.
+    The view is only valid until the next read. File objects without
+    readinto, like the streaming helpers in imgutils, are read normally.
+    """
+
+    def __init__(self, fobj, blocksize):
+        self.fobj = fobj
+        self.buf = bytearray(blocksize)
+        self.view = memoryview(self.buf)
+
+    def read(self, size=None):
+        if size is None or size > len(self.buf):
+            size = len(self.buf)
+        if not hasattr(self.fobj, 'readinto'):
+            return self.fobj.read(size)
+        filled = 0
+        # short reads happen on pipes, fill the chunk unless the file ended
+        while filled < size:
+            count = self.fobj.readinto(self.view[filled:size])
+            if not count:
+                break
+            filled += count
+        return self.view[:filled]
+
+
+class ChunkSizer(object):
+    """Pick upload chunk sizes from the measured time of each chunk.
+
+    Chunks that finish quicker than fast seconds are doubled, since request
+    overhead dominates them. Chunks slower than slow seconds are halved, so
+    a failed request does not cost too much. The size stays within the
+    minimum and maximum given in bytes.
+    """
+
+    def __init__(self, start, minimum, maximum, fast=2.0, slow=10.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = max(minimum, min(start, maximum))
+        self.fast = fast
+        self.slow = slow
+        self.chunks = 0
+        self.sent = 0
+        self.elapsed = 0.0
+
+    def update(self, sent, elapsed):
+        """Record a chunk of sent bytes that took elapsed seconds."""
+        self.chunks += 1
+        self.sent += sent
+        self.elapsed += elapsed
+        if sent < self.size:
+            # the last chunk of a file says nothing about the network
+            return
+        if elapsed < self.fast and self.size < self.maximum:
+            self.size = min(self.size * 2, self.maximum)
+            log.debug('growing chunk size to %sM' % (self.size / (1024 * 1024),))
+        elif elapsed > self.slow and self.size > self.minimum:
+            self.size = max(self.size // 2, self.minimum)
+            log.debug('shrinking chunk size to %sM' % (self.size / (1024 * 1024),))
+
+    def throughput(self):
+        """Return the average throughput in bytes per second."""
+        if not self.elapsed:
+            return 0
+        return self.sent / self.elapsed
+
+
+class PollInterval(object):
+    """Produce the intervals to sleep between polls of a task.
+
+    The first interval is initial seconds, every following one is factor
+    times longer, up to maximum seconds. Quick tasks are noticed within
+    milliseconds while long ones do not flood Pulp with requests.
+    """
+
+    def __init__(self, initial=0.05, maximum=5.0, factor=2.0):
+        self.maximum = maximum
+        self.factor = factor
+        self.current = min(initial, maximum)
+
+    @classmethod
+    def fixed(cls, interval):
+        """Return intervals that are always the same."""
+        return cls(interval, interval, 1)
+
+    def step(self):
+        """Return the next interval in seconds."""
+        interval = self.current
+        self.current = min(self.current * self.factor, self.maximum)
+        return interval
+
+
+class TaskWatcher(object):
+    """Poll the tasks that many threads wait on with one request per tick.
+
+    Waiters register their task IDs in wait(). A single poller thread runs
+    while anybody waits. Each tick it fetches all outstanding tasks at once
+    and wakes the waiters whose tasks ended. A newly registered task restarts
+    the poll interval curve, so it is noticed quickly. An error fetching one
+    task only fails the waiters of that task; a failed search is retried on
+    the next tick, and only fails every waiter after max_errors in a row.
+    """
+
+    max_errors = 3
+
+    def __init__(self, pulp):
+        self.pulp = pulp
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.waiters = {}  # task ID -> number of waiters
+        self.reports = {}  # task ID -> final report, or the exception polling raised
+        self.thread = None
+        self.fresh = False
+
+    def wait(self, task_ids, timeout=None):
+        """Wait until at least one of the tasks ended.
+
+        Returns a dict of task ID to the final report of every ended task, or
+        an empty dict if timeout seconds passed first. Errors raised while
+        polling are re-raised here.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            for tid in task_ids:
+                self.waiters[tid] = self.waiters.get(tid, 0) + 1
+            self.fresh = True
+            self.wakeup.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='dockpulp-task-watcher')
+                self.thread.daemon = True
+                self.thread.start()
+            try:
+                while True:
+                    ended = dict((tid, self.reports[tid]) for tid in task_ids
+                                 if tid in self.reports)
+                    for report in ended.values():
+                        if isinstance(report, Exception):
+                            raise report
+                    if ended:
+                        return ended
+                    if deadline is None:
+                        self.cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return {}
+                        self.cond.wait(remaining)
+            finally:
+                for tid in task_ids:
+                    self.waiters[tid] -= 1
+                    if not self.waiters[tid]:
+                        del self.waiters[tid]
+                        self.reports.pop(tid, None)
+
+    def notify(self, task_ids=None):
+        """Poll right away, unless the given task IDs are not waited on."""
+        with self.cond:
+            if task_ids and not set(task_ids) & set(self.waiters):
+                return
+            self.wakeup.set()
+
+    def _sleep(self, interval):
+        # woken early when a new task is registered or an event arrives
+        self.wakeup.wait(interval)
+
+    def _run(self):
+        intervals = None
+        errors_in_row = 0
+        while True:
+            with self.cond:
+                self.wakeup.clear()
+                task_ids = sorted(tid for tid in self.waiters if tid not in self.reports)
+                if not task_ids:
+                    self.thread = None
+                    return
+                if self.fresh or intervals is None:
+                    intervals = self.pulp._pollIntervals()
+                    self.fresh = False
+            try:
+                ended = self.pulp._pollTasks(task_ids)
+                errors_in_row = 0
+            except Exception as e:
+                errors_in_row += 1
+                if errors_in_row < self.max_errors:
+                    log.warning('polling tasks failed, trying again: %s' % e)
+                    self._sleep(intervals.step())
+                    continue
+                ended = dict((tid, e) for tid in task_ids)
+            with self.cond:
+                for tid, report in ended.items():
+                    if tid in self.waiters:
+                        self.reports[tid] = report
+                self.cond.notify_all()
+                if all(tid in self.reports for tid in self.waiters):
+                    # nothing left to poll, do not sleep before stopping
+                    continue
+            self._sleep(intervals.step())
+
+
+class _EventHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accept the notifications POSTed by Pulp's http notifier."""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.end_headers()
+        self.server.receiver.received(body)
+
+    def log_message(self, format, *args):
+        log.debug('event listener: %s' % (format % args))
+
+
+class TaskEventReceiver(object):
+    """Receive Pulp event notifications over HTTP and wake the task watcher.
+
+    A small HTTP server runs in a daemon thread on the port of url. Every
+    event that names a task the watcher waits on, or that names no task at
+    all, makes the watcher poll right away.
+    """
+
+    def __init__(self, watcher, url):
+        parsed = urlparse(url)
+        self.watcher = watcher
+        self.events = 0
+        self.server = BaseHTTPServer.HTTPServer(('', parsed.port or 80), _EventHandler)
+        self.server.receiver = self
+        # port 0 picks a free port, advertise the one we got
+        self.url = '%s://%s:%s%s' % (parsed.scheme, parsed.hostname,
+                                     self.server.server_address[1], parsed.path or '/')
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='dockpulp-event-listener')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('listening for pulp events on %s' % self.url)
+
+    def received(self, body):
+        """Handle the body of one notification."""
+        self.events += 1
+        try:
+            event = json.loads(body.decode('utf-8'))
+        except ValueError:
+            log.debug('ignoring malformed pulp event')
+            return
+        log.debug('pulp event: %s' % event.get('event_type'))
+        task_ids = []
+        for key in ('call_report', 'payload'):
+            if isinstance(event.get(key), dict) and event[key].get('task_id'):
+                task_ids.append(event[key]['task_id'])
+        self.watcher.notify(task_ids)
+
+    def close(self):
+        """Stop the HTTP server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Throttle(object):
+    """Hold back new tasks while the Pulp task queue is too deep.
+
+    The number of waiting and running tasks is kept below target per
+    worker. Pulp is asked at most every refresh seconds; the tasks admitted
+    in between are counted locally.
+    """
+
+    def __init__(self, pulp, target, refresh=2.0):
+        self.pulp = pulp
+        self.target = target
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.depth = None
+        self.limit = None
+        self.admitted = 0
+        self.checked = 0
+
+    def _measure(self):
+        workers = [w for w in self.pulp.getWorkers()
+                   if w['name'].startswith('reserved_resource_worker')]
+        self.limit = max(1, len(workers)) * self.target
+        self.depth = self.pulp.getQueueDepth()
+        self.admitted = 0
+        self.checked = time.time()
+        log.info('pulp task queue depth is %s, limit %s for %s workers' %
+                 (self.depth, self.limit, len(workers)))
+
+    def admit(self):
+        """Block until there is room for one more task in the queue."""
+        intervals = PollInterval(self.refresh / 4, self.refresh * 4)
+        while True:
+            with self.lock:
+                if self.depth is None or time.time() - self.checked >= self.refresh:
+                    self._measure()
+                if self.depth + self.admitted < self.limit:
+                    self.admitted += 1
+                    return
+            interval = intervals.step()
+            log.debug('pulp task queue is full, waiting %s seconds' % interval)
+            time.sleep(interval)
+
+
+class TaskFuture(object):
+    """Pulp tasks started by a mutating operation that may still be running.
+
+    Returned by the mutating Pulp methods when called with future=True, so
+    callers can start many operations before waiting on any of them.
+    """
+
+    def __init__(self, pulp, task_ids):
+        self.pulp = pulp
+        self.task_ids = list(task_ids)
+        self._reports = None
+        self._error = None
+
+    @property
+    def task_id(self):
+        """Return the ID of the last task of the operation."""
+        return self.task_ids[-1] if self.task_ids else None
+
+    def done(self):
+        """Return whether every task ended, asking Pulp at most once."""
+        if self._reports is not None or self._error is not None or not self.task_ids:
+            return True
+        return len(self.pulp._pollTasks(self.task_ids)) == len(self.task_ids)
+
+    def result(self, timeout=None):
+        """Wait for the tasks and return their reports in task_ids order.
+
+        Failed tasks raise the same errors as Pulp.watch.
+        """
+        if self._error is not None:
+            raise self._error
+        if self._reports is None:
+            try:
+                self._reports = [self.pulp.watch(tid, timeout=timeout) for tid in self.task_ids]
+            except errors.DockPulpError as e:
+                self._error = e
+                raise
+        return self._reports
+
+
 class RequestsHttpCaller(object):
     def __init__(self, url, retries=0):
         self.url = url
@@ -800,8 +1166,19 @@ class Pulp(object):
                                ('release_order', "_set_env_attr", "release_order"))
     OPTIONAL_CONF_SECTIONS = (('certificates', "_set_cert", None),
                               ('chunk_size', "_set_int_attr", "chunk_size"),
+                              ('chunk_size_min', "_set_int_attr", "chunk_size_min"),
+                              ('chunk_size_max', "_set_int_attr", "chunk_size_max"),
                               ('timeout', "_set_int_attr", "timeout"),
+                              ('poll_initial', "_set_float_attr", "poll_initial"),
+                              ('poll_max', "_set_float_attr", "poll_max"),
+                              ('poll_factor', "_set_float_attr", "poll_factor"),
+                              ('event_listener', "_set_env_attr", "event_listener"),
+                              ('publish_concurrency', "_set_int_attr", "publish_concurrency"),
+                              ('queue_target', "_set_int_attr", "queue_target"),
+                              ('search_concurrency', "_set_int_attr", "search_concurrency"),
+                              ('event_poll', "_set_float_attr", "event_poll"),
                               ('retries', "_set_int_attr", "retries"),
+                              ('clock_skew', "_set_int_attr", "clock_skew"),
                               ('distribution', "_set_bool", "dists"),
                               ('signatures', "_set_independent_attr", "sigs"),
                               ('sig_exception', "_set_env_attr", "sig_exception"),
@@ -846,6 +1223,35 @@ class Pulp(object):
             self.timeout = 180
         if not hasattr(self, 'dists'):
             self.dists = False
+        self.watcher = TaskWatcher(self)
+        self.events = None
+        # watch() runs in many threads, only one may start the listener
+        self._events_lock = threading.RLock()
+        if not hasattr(self, 'event_listener'):
+            self.event_listener = None
+        if getattr(self, 'event_poll', None) is None:
+            self.event_poll = 30.0
+        if getattr(self, 'publish_concurrency', None) is None:
+            self.publish_concurrency = 4
+        if not hasattr(self, 'queue_target'):
+            self.queue_target = None
+        if getattr(self, 'search_concurrency', None) is None:
+            self.search_concurrency = 4
+        if getattr(self, 'clock_skew', None) is None:
+            self.clock_skew = 60
+        self._throttle = None
+        self._content_sources = {}
+        self._pulp_version = None
+        if getattr(self, 'poll_initial', None) is None:
+            self.poll_initial = 0.05
+        if getattr(self, 'poll_max', None) is None:
+            self.poll_max = 5.0
+        if getattr(self, 'poll_factor', None) is None:
+            self.poll_factor = 2.0
+        if not hasattr(self, 'chunk_size_min'):
+            self.chunk_size_min = None
+        if not hasattr(self, 'chunk_size_max'):
+            self.chunk_size_max = None
         if not hasattr(self, 'sig_exception'):
             self.sig_exception = None
         if not hasattr(self, 'dist_switchover'):
@@ -896,6 +1302,15 @@ class Pulp(object):
                     pass
         return None
 
+    def _set_float_attr(self, attrs):
+        for key, val in attrs:
+            if self.env == key:
+                try:
+                    return float(val)
+                except TypeError:
+                    pass
+        return None
+
     def _load_override_conf(self, config_override):
         if not isinstance(config_override, dict):
             return
@@ -984,23 +1399,78 @@ class Pulp(object):
     def _find_content_source(self, content_id, content_filter, content_types):
         # content_filter: 'digest' or 'image_id'
         # content_types: [V2_C_TYPE, V2_LIST, V2_BLOB] or [V1_C_TYPE]
+        return self._find_content_sources([content_id], content_filter, content_types)[content_id]
 
-        search_data = json.dumps({
-            'criteria': {
-                'filters': {
-                    content_filter: content_id
-                },
-            },
-            'include_repos': True
-        })
+    def _find_content_sources(self, content_ids, content_filter, content_types):
+        """Return a dict of content ID to a repository that holds it.
+
+        Runs one $in search per content type, in batches of BATCH_SIZE, for
+        the IDs not found yet. Results are remembered for the session.
+        """
+        sources = {}
+        missing = []
+        for content_id in content_ids:
+            if (content_filter, content_id) in self._content_sources:
+                sources[content_id] = self._content_sources[(content_filter, content_id)]
+            elif content_id not in missing:
+                missing.append(content_id)
         for content_type in content_types:
-            result = self._post('/pulp/api/v2/content/units/%s/search/' % content_type,
-                                data=search_data)
-            if result:
-                source = result[0]['repository_memberships'][0]
-                return source
+            if not missing:
+                break
+            result = self._search_in(
+                '/pulp/api/v2/content/units/%s/search/' % content_type, missing,
+                lambda batch: {
+                    'criteria': {
+                        'filters': {
+                            content_filter: {
+                                '$in': batch
+                            }
+                        },
+                        'fields': [content_filter],
+                    },
+                    'include_repos': True
+                })
+            for unit in result:
+                if unit.get('repository_memberships'):
+                    source = unit['repository_memberships'][0]
+                    sources.setdefault(unit[content_filter], source)
+                    self._content_sources[(content_filter, unit[content_filter])] = source
+            missing = [content_id for content_id in missing if content_id not in sources]
+
+        if missing:
+            raise errors.DockPulpError('Image cannot be found in Pulp: %s' % ', '.join(missing))
+        return sources
+
+    def _search_in(self, api, values, make_data, workers=None):
+        """Run a search with an $in list of values, in batches, and merge the results.
+
+        make_data returns the request body for one batch of at most
+        BATCH_SIZE values. Batches run search_concurrency at a time, and the
+        results are concatenated in batch order.
+        """
+        values = list(values)
+        batches = [[v for v in batch if v is not None]
+                   for batch in grouper(values, int(BATCH_SIZE))] or [values]
+
+        def search(batch):
+            return self._post(api, data=json.dumps(make_data(batch)))
+
+        if len(batches) == 1:
+            return search(batches[0])
+        log.debug('searching %s values in %s batches' % (len(values), len(batches)))
+        pool = ThreadPool(min(workers or self.search_concurrency, len(batches)))
+        try:
+            results = pool.map(search, batches)
+        finally:
+            pool.close()
+            pool.join()
+        return [item for result in results for item in result]
 
-        raise errors.DockPulpError('Image cannot be found in Pulp: %s' % content_id)
+    def _forget_content_sources(self, repo):
+        """Drop the remembered content sources in repo, as content leaves it."""
+        for key, source in list(self._content_sources.items()):
+            if source == repo:
+                self._content_sources.pop(key, None)
 
     # public methods start here, alphabetically
 
@@ -1065,11 +1535,11 @@ class Pulp(object):
                 response['error'] = True
         return response
 
-    def cleanOrphans(self, content_type=V1_C_TYPE):
+    def cleanOrphans(self, content_type=V1_C_TYPE, future=False):
         """Remove orphaned docker content of given type."""
         log.debug('Removing docker orphans not implemented in Pulp 2.4')
         tid = self._delete('/pulp/api/v2/content/orphans/%s/' % content_type)
-        self.watch(tid)
+        return self._finish([tid], future)
 
     def cleanUploadRequests(self):
         """Remove outstanding upload requests from Pulp to reclaim space."""
@@ -1077,8 +1547,34 @@ class Pulp(object):
         for upload in uploads:
             self._deleteUploadRequest(upload)
 
-    def copy(self, drepo, img, source=None):
-        """Copy an image from one repo to another."""
+    def collectGarbage(self, plan, manifests=False, future=False):
+        """Remove the content in a plan from getGarbagePlan, then its orphans.
+
+        Each repository is cleaned with batched unassociate tasks, and the
+        orphaned units are then removed with one task per content type. That
+        removes every orphan of the type in the environment, not only the
+        ones the plan left. Manifests and manifest lists are only part of the
+        orphan pass if manifests is True, as in getGarbagePlan.
+        """
+        futures = [self.remove(repo, ids, future=True)
+                   for repo, ids in sorted(plan.items()) if ids]
+        self.watch_futures(futures)
+        content_types = [V1_C_TYPE, V2_BLOB]
+        if manifests:
+            content_types.extend([V2_C_TYPE, V2_LIST])
+        tids = []
+        for content_type in content_types:
+            log.info('removing orphaned %s units' % content_type)
+            tids.append(self._delete('/pulp/api/v2/content/orphans/%s/' % content_type))
+        if future:
+            return TaskFuture(self, tids)
+        self.watch_tasks(tids)
+
+    def copy(self, drepo, img, source=None, future=False):
+        """Copy an image from one repo to another.
+
+        With future, a TaskFuture is returned instead of waiting.
+        """
         if img.startswith("sha256:"):
             content_types = [V2_C_TYPE, V2_LIST, V2_BLOB]
             if source is None:
@@ -1121,9 +1617,67 @@ class Pulp(object):
         tid = self._post(
             '/pulp/api/v2/repositories/%s/actions/associate/' % drepo,
             data=json.dumps(data))
-        self.watch(tid)
+        return self._finish([tid], future)
 
-    def copy_filters(self, drepo, source=HIDDEN, filters={}, v1=True, v2=True):
+    def copyMany(self, drepo, ids, source=None, future=False):
+        """Copy many images or digests into a repo with as few tasks as possible.
+
+        The IDs are grouped by source repo and by content type, image IDs or
+        digests. Each group is copied by one associate request with an $in
+        filter, BATCH_SIZE IDs at most. All tasks are watched together, or
+        returned as one TaskFuture with future.
+        """
+        digests = [content_id for content_id in ids if content_id.startswith("sha256:")]
+        image_ids = [content_id for content_id in ids if not content_id.startswith("sha256:")]
+        groups = {}
+        for content_filter, content_types, content_ids in (
+                ('digest', [V2_C_TYPE, V2_LIST, V2_BLOB], digests),
+                ('image_id', [V1_C_TYPE], image_ids)):
+            if not content_ids:
+                continue
+            if source is None:
+                sources = self._find_content_sources(content_ids, content_filter, content_types)
+            else:
+                sources = dict((content_id, source) for content_id in content_ids)
+            for content_id in content_ids:
+                groups.setdefault((sources[content_id], content_filter), []).append(content_id)
+
+        throttle = self.throttle()
+        tids = []
+        for (src, content_filter), group in sorted(groups.items()):
+            for batch in grouper(group, int(BATCH_SIZE)):
+                batch = [content_id for content_id in batch if content_id is not None]
+                if content_filter == 'digest':
+                    type_ids = [V2_C_TYPE, V2_LIST, V2_BLOB]
+                    unit_filter = {"$or": [{'digest': {'$in': batch}},
+                                           {'manifest_digest': {'$in': batch}}]}
+                else:
+                    type_ids = [V1_C_TYPE]
+                    unit_filter = {'image_id': {'$in': batch}}
+                data = {
+                    'source_repo_id': src,
+                    'criteria': {
+                        'type_ids': type_ids,
+                        'filters': {
+                            'unit': unit_filter
+                        }
+                    },
+                    'override_config': {}
+                }
+                log.debug('copy request we are sending:')
+                log.debug(pprint.pformat(data))
+                log.info('copying %s units from %s to %s' % (len(batch), src, drepo))
+                if throttle is not None:
+                    throttle.admit()
+                tids.append(self._post(
+                    '/pulp/api/v2/repositories/%s/actions/associate/' % drepo,
+                    data=json.dumps(data)))
+        if future:
+            return TaskFuture(self, tids)
+        if tids:
+            self.watch_tasks(tids)
+
+    def copy_filters(self, drepo, source=HIDDEN, filters={}, v1=True, v2=True, future=False):
         """Copy content from one repo to another according to filters."""
         type_ids = []
         if v1:
@@ -1144,33 +1698,40 @@ class Pulp(object):
         tid = self._post(
             '/pulp/api/v2/repositories/%s/actions/associate/' % drepo,
             data=json.dumps(data))
-        self.watch(tid)
-
-    def crane(self, repos=[], wait=True, skip=False, force_refresh=False):
-        """Export pulp configuration to crane for one or more repositories."""
+        return self._finish([tid], future)
+
+    def crane(self, repos=[], wait=True, skip=False, force_refresh=False, future=False,
+              concurrency=None):
+        """Export pulp configuration to crane for one or more repositories.
+
+        Up to concurrency repositories, publish_concurrency by default, are
+        published at the same time. The distributors of a repository are
+        always published in release order, each one after the previous
+        finished. Without wait, or with future, the publish tasks are only
+        queued; Pulp runs the tasks of a repository one after another, so the
+        order still holds. future returns a TaskFuture for all of them.
+        With queue_target configured, publishing waits while the Pulp task
+        queue is full.
+        """
         if isinstance(repos, six.text_type) or isinstance(repos, six.binary_type):
             repos = [repos]
 
         if len(repos) == 0:
             repos = self.getAllRepoIDs()
-        tasks = []
-        results = []
-
-        if not wait:
-            pool = multiprocessing.Pool()
-
-        for repo in repos:
-            distributors = []
-            releasekeys = self.release_order.strip().split(",")
-            for key in releasekeys:
-                distributors.append(self.distributorconf[key])
+        if concurrency is None:
+            concurrency = self.publish_concurrency
+        distributors = []
+        releasekeys = self.release_order.strip().split(",")
+        for key in releasekeys:
+            distributors.append(self.distributorconf[key])
+        throttle = self.throttle()
+
+        def publish(repo):
+            tasks = []
             for distributor in distributors:
                 dist_id = distributor['distributor_id']
-                override = {}
-                try:
-                    override = distributor['override_config']
-                except KeyError:
-                    pass
+                # copied, the distributor config is shared by all threads
+                override = dict(distributor.get('override_config', {}))
 
                 if skip:
                     override['force_full'] = skip
@@ -1178,22 +1739,26 @@ class Pulp(object):
                     override['delete'] = force_refresh
                 log.info('updating distributor: %s' % dist_id)
                 url = '/pulp/api/v2/repositories/%s/actions/publish/' % repo
-                kwds = {"data": json.dumps({'id': dist_id, 'override_config': override})}
-                log.debug('sending %s' % kwds)
-                if not wait:
-                    results.append(pool.apply_async(self._request,
-                                                    args=("post", url,),
-                                                    kwds=kwds))
-                else:
-                    tid = self._post(url, data=kwds["data"])
-                    self.watch(tid)
-                    tasks.append(tid)
-        if not wait:
+                data = json.dumps({'id': dist_id, 'override_config': override})
+                log.debug('sending %s' % data)
+                if throttle is not None:
+                    throttle.admit()
+                tid = self._post(url, data=data)
+                if wait and not future:
+                    # a finished publish may still report that it failed
+                    self.watch_tasks([tid])
+                tasks.append(tid)
+            return tasks
+
+        pool = ThreadPool(max(1, min(concurrency, len(repos))))
+        try:
+            tasks = [tid for repo_tasks in pool.map(publish, repos) for tid in repo_tasks]
+        finally:
             pool.close()
             pool.join()
-            return [result.get() for result in results]
-        else:
-            return tasks
+        if future:
+            return TaskFuture(self, tasks)
+        return tasks
 
     def createOriginRepo(self, repo_id):
         if not repo_id.startswith(ORIGIN_PREFIX):
@@ -1208,10 +1773,11 @@ class Pulp(object):
     def createRepo(self, repo_id, url, registry_id=None, desc=None, title=None, protected=False,
                    distributors=True, prefix_with=PREFIX, productline=None, library=False,
                    distribution=None, repotype=None, importer_type_id=None, rel_url=None,
-                   download=None, is_origin=False):
+                   download=None, is_origin=False, origin=True):
         """Create a docker repository in pulp.
 
-        id and description are required
+        id and description are required. The origin- repo is created too if
+        it is missing, unless origin is False.
         """
         if not repo_id.startswith(prefix_with):
             repo_id = prefix_with + repo_id
@@ -1314,7 +1880,7 @@ class Pulp(object):
             # dist_switchover is an optional section in dockpulp.conf
             # Used for changes in Pulp distributor types
             if self.dist_switchover:
-                pulpversion = self.getPulpVersion()
+                pulpversion = self._pulp_version or self.getPulpVersion()
             for key, value in self.dist_switchover.items():
                 if LooseVersion(pulpversion) >= LooseVersion(key):
                     if value.count(',') != 1:
@@ -1332,7 +1898,7 @@ class Pulp(object):
                     if dtype == before_id:
                         log.debug('Using new distributor type %s for distributor %s', type_id, key)
                         self.distributorconf[key]['distributor_type_id'] = type_id
-                stuff['distributors'].append(self.distributorconf[key])
+                stuff['distributors'].append(copy.deepcopy(self.distributorconf[key]))
             for distributor in stuff['distributors']:
                 try:
                     if distributor['distributor_type_id'] == 'docker_distributor_web':
@@ -1347,7 +1913,7 @@ class Pulp(object):
         else:
             stuff['distributors'] = []
 
-        if not is_origin and repo_id != HIDDEN:
+        if origin and not is_origin and repo_id != HIDDEN:
             # want to create origin- repo for every new repo
             # do this at the end in case of errors
             self.createOriginRepo(repo_id)
@@ -1357,8 +1923,63 @@ class Pulp(object):
         self._post('/pulp/api/v2/repositories/', data=json.dumps(stuff))
         return stuff
 
-    def deleteRepo(self, repo, publish=False):
-        """Delete a repository; cannot be undone!."""
+    def createRepos(self, specs, workers=4):
+        """Create many docker repositories.
+
+        specs is a list of dicts of createRepo keyword arguments, with
+        repo_id and url at least. One search finds which of the repos and
+        their origin- repos exist already; existing repos are skipped, and
+        the others are created up to workers at a time, with one Pulp version
+        lookup. Returns the createRepo results of the repos created.
+        """
+        specs = [dict(spec) for spec in specs]
+        for spec in specs:
+            prefix_with = spec.get('prefix_with', PREFIX)
+            if not spec['repo_id'].startswith(prefix_with):
+                spec['repo_id'] = prefix_with + spec['repo_id']
+        origins = dict((spec['repo_id'], ORIGIN_PREFIX + spec['repo_id']) for spec in specs
+                       if not spec.get('is_origin') and spec['repo_id'] != HIDDEN)
+        ids = [spec['repo_id'] for spec in specs] + list(origins.values())
+        existing = set(blob['id'] for blob in self._search_in(
+            '/pulp/api/v2/repositories/search/', ids,
+            lambda batch: {
+                'criteria': {
+                    'filters': {
+                        'id': {'$in': batch}
+                    },
+                    'fields': ['id'],
+                }
+            }))
+        for spec in specs:
+            if spec['repo_id'] in existing:
+                log.info('repo %s already exists, skipping' % spec['repo_id'])
+        specs = [spec for spec in specs if spec['repo_id'] not in existing]
+        if not specs:
+            return []
+
+        def create(spec):
+            origin_id = origins.get(spec['repo_id'])
+            if origin_id is not None and origin_id not in existing:
+                self.createRepo(origin_id, None, distributors=False, prefix_with=ORIGIN_PREFIX,
+                                is_origin=True)
+            return self.createRepo(origin=False, **spec)
+
+        log.info('creating %s repos' % len(specs))
+        if self.dist_switchover:
+            self._pulp_version = self.getPulpVersion()
+        pool = ThreadPool(max(1, min(workers, len(specs))))
+        try:
+            return pool.map(create, specs)
+        finally:
+            pool.close()
+            pool.join()
+            self._pulp_version = None
+
+    def deleteRepo(self, repo, publish=False, future=False):
+        """Delete a repository; cannot be undone!.
+
+        With future, only the deletion itself is not waited for.
+        """
         if publish:
             log.info('removing images and manifests from repo %s', repo)
             self.emptyRepo(repo)
@@ -1367,8 +1988,9 @@ class Pulp(object):
             # Need to publish twice due to order of distributors
             self.crane(repo, force_refresh=True)
         log.info('deleting repo %s' % repo)
+        self._forget_content_sources(repo)
         tid = self._delete('/pulp/api/v2/repositories/%s/' % repo)
-        self.watch(tid)
+        return self._finish([tid], future)
 
     def disassociate(self, dist_id, repo):
         """Disassociate a distributor associated with a repo."""
@@ -1412,6 +2034,54 @@ class Pulp(object):
         repos.remove(HIDDEN)  # remove the RCM-internal repository
         return repos
 
+    def getStaleRepoIDs(self, repos=None):
+        """Return the IDs of repositories that changed since they were published.
+
+        A repository is stale if a distributor in release_order was never
+        published, or was published before the last unit was added or
+        removed, or before the tags were last updated. All repositories, or
+        the given ones, are checked with one search.
+
+        Unit timestamps come from the Pulp server, but tags_updated is
+        stamped by the client and only has second resolution, so tags
+        updated up to clock_skew seconds after a publish still count as
+        changed. At worst such a repository is published once more.
+        """
+        criteria = {
+            'fields': ['id', 'last_unit_added', 'last_unit_removed', 'scratchpad'],
+        }
+        if repos is not None:
+            criteria['filters'] = {'id': {'$in': list(repos)}}
+        data = {'criteria': criteria, 'distributors': True}
+        log.info('checking which repositories changed since their last publish...')
+        blobs = self._post('/pulp/api/v2/repositories/search/', data=json.dumps(data))
+        dist_ids = [self.distributorconf[key]['distributor_id']
+                    for key in self.release_order.strip().split(",")]
+        stale = []
+        for blob in blobs:
+            if blob['id'] == HIDDEN:
+                continue
+            changes = [parse_timestamp(blob.get('last_unit_added')),
+                       parse_timestamp(blob.get('last_unit_removed'))]
+            tagged = parse_timestamp((blob.get('scratchpad') or {}).get('tags_updated'))
+            if tagged is not None:
+                # the client clock may run behind the server one
+                changes.append(tagged + timedelta(seconds=self.clock_skew))
+            changed = max([c for c in changes if c is not None] or [None])
+            published = dict((d['id'], parse_timestamp(d.get('last_publish')))
+                             for d in blob.get('distributors', []))
+            for dist_id in dist_ids:
+                if dist_id not in published:
+                    continue
+                last_publish = published[dist_id]
+                if last_publish is None or (changed is not None and changed >= last_publish):
+                    log.debug('%s changed since %s was published' % (blob['id'], dist_id))
+                    stale.append(blob['id'])
+                    break
+        stale.sort()
+        log.info('%s of %s repositories changed' % (len(stale), len(blobs)))
+        return stale
+
     def getAncestors(self, iid, parents=None):
         """Return the list of layers (ancestors) of a given image."""
         # a rest call is made per parent, which impacts performance greatly
@@ -1441,6 +2111,153 @@ class Pulp(object):
         else:
             return parents
 
+    def getAncestry(self, iids, parents=None):
+        """Return a dict mapping each image ID to its list of ancestors.
+
+        parents is an optional dict of image ID to parent ID, such as the one
+        returned by getImageParents, used as the starting graph. Parents not
+        in it are looked up with one batched search per generation, and the
+        ancestry of each image is resolved once and shared by its children.
+        """
+        parents = dict(parents or {})
+        unknown = set()
+        seen = set()
+        for iid in iids:
+            cur = iid
+            while cur is not None and cur not in seen:
+                seen.add(cur)
+                if cur not in parents:
+                    unknown.add(cur)
+                    break
+                cur = parents[cur]
+        while unknown:
+            found = self._searchImageParents(sorted(unknown))
+            for iid in unknown:
+                if iid not in found:
+                    log.info('missing parent layer %s', iid)
+                    log.info('skipping layer')
+                parents[iid] = found.get(iid)
+            unknown = set(par for par in found.values()
+                          if par is not None and par not in parents)
+
+        ancestry = {}
+        for iid in iids:
+            path = []
+            cur = iid
+            while cur is not None and cur not in ancestry:
+                path.append(cur)
+                cur = parents.get(cur)
+                if cur in path:
+                    log.warning('image %s is its own ancestor', cur)
+                    cur = None
+            tail = [] if cur is None else [cur] + ancestry[cur]
+            for node in reversed(path):
+                ancestry[node] = tail
+                tail = [node] + tail
+        return dict((iid, list(ancestry[iid])) for iid in iids)
+
+    def _searchImageParents(self, iids):
+        """Return a dict of image ID to parent ID for the v1 images found."""
+        log.debug('searching parents of %s', ', '.join(iids))
+        result = self._search_in(
+            '/pulp/api/v2/content/units/%s/search/' % V1_C_TYPE, iids,
+            lambda batch: {
+                'criteria': {
+                    'filters': {
+                        'image_id': {'$in': batch}
+                    },
+                    'fields': ['image_id', 'parent_id'],
+                },
+            })
+        return dict((img['image_id'], img.get('parent_id')) for img in result)
+
+    def getGarbagePlan(self, workers=4, manifests=False, paginate=True):
+        """Return the layers and blobs nothing in the environment needs, per repository.
+
+        Units of every repository, the hidden one included, are fetched in
+        parallel with a projection. Tagged v1 images and their ancestors are
+        needed, and so is every blob referenced by a manifest that is kept.
+        All manifests and manifest lists are kept, since untagged ones can
+        still be pulled by digest, unless manifests is True: then only tagged
+        manifests and manifest lists, and the manifests those lists reference,
+        are kept, and the others are part of the plan. Returns a dict of
+        repository ID to the sorted image IDs and digests of the unneeded
+        units it holds.
+        """
+        data = {'criteria': {'fields': ['id', 'scratchpad']}}
+        blobs = self._post('/pulp/api/v2/repositories/search/', data=json.dumps(data))
+        repo_ids = [blob['id'] for blob in blobs]
+        log.info('collecting content units of %s repositories' % len(repo_ids))
+
+        def collect(repo_id):
+            return self._collect_repo_units(
+                repo_id, paginate=paginate,
+                type_ids=[V1_C_TYPE, V2_C_TYPE, V2_BLOB, V2_TAG, V2_LIST],
+                fields=['image_id', 'parent_id', 'digest', 'manifest_digest', 'manifests',
+                        'fs_layers', 'config_layer'])
+
+        pool = ThreadPool(max(1, min(workers, len(repo_ids))))
+        try:
+            repo_units = pool.map(collect, repo_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+        parents = {}
+        tagged_images = set()
+        tagged_digests = set()
+        lists = {}
+        layers = {}
+        held = {}
+        for blob, units in zip(blobs, repo_units):
+            tags = (blob.get('scratchpad') or {}).get('tags', [])
+            tagged_images.update(tag['image_id'] for tag in tags)
+            held[blob['id']] = ids = set()
+            for unit in units:
+                unit_type = unit['unit_type_id']
+                metadata = unit['metadata']
+                if unit_type == V1_C_TYPE:
+                    parents[metadata['image_id']] = metadata.get('parent_id')
+                    ids.add(metadata['image_id'])
+                elif unit_type == V2_TAG:
+                    tagged_digests.add(metadata['manifest_digest'])
+                elif unit_type == V2_LIST:
+                    lists[metadata['digest']] = [
+                        m['digest'] if isinstance(m, dict) else m
+                        for m in metadata.get('manifests', [])]
+                    ids.add(metadata['digest'])
+                elif unit_type == V2_C_TYPE:
+                    blob_sums = [layer['blob_sum'] for layer in metadata.get('fs_layers', [])]
+                    if metadata.get('config_layer'):
+                        blob_sums.append(metadata['config_layer'])
+                    layers[metadata['digest']] = blob_sums
+                    ids.add(metadata['digest'])
+                elif unit_type == V2_BLOB:
+                    ids.add(metadata['digest'])
+
+        needed = set(tagged_images)
+        for ancestors in self.getAncestry(sorted(tagged_images & set(parents)),
+                                          parents=parents).values():
+            needed.update(ancestors)
+        if manifests:
+            needed.update(tagged_digests)
+            for digest in tagged_digests & set(lists):
+                needed.update(lists[digest])
+        else:
+            needed.update(lists)
+            needed.update(layers)
+        for digest in needed & set(layers):
+            needed.update(layers[digest])
+
+        plan = {}
+        for repo_id, ids in held.items():
+            garbage = ids - needed
+            if garbage:
+                plan[repo_id] = sorted(garbage)
+        log.info('%s units in %s repositories are not needed' %
+                 (sum(len(ids) for ids in plan.values()), len(plan)))
+        return plan
+
     def getDistributionSig(self, dist):
         """Get distribution signature."""
         # No longer used, keeping for unit tests
@@ -1448,19 +2265,36 @@ class Pulp(object):
 
     def getImageIdsExist(self, iids=[]):
         """Return a list of layers already uploaded to the server."""
-        data = json.dumps({
-            'criteria': {
-                'filters': {
-                    'image_id': {"$in": iids}
-                },
-            },
-        })
         log.debug('checking imageids %s', ', '.join(iids))
-        log.debug(data)
-        result = self._post('/pulp/api/v2/content/units/%s/search/' % V1_C_TYPE, data=data)
+        result = self._search_in(
+            '/pulp/api/v2/content/units/%s/search/' % V1_C_TYPE, iids,
+            lambda batch: {
+                'criteria': {
+                    'filters': {
+                        'image_id': {"$in": batch}
+                    },
+                },
+            })
         log.debug(result)
         return [c['image_id'] for c in result]
 
+    def getImageParents(self, repo):
+        """Return a dict of image ID to parent ID for the v1 images in a repo."""
+        data = {
+            'criteria': {
+                'type_ids': [V1_C_TYPE],
+                'fields': {
+                    'unit': ['image_id', 'parent_id'],
+                },
+            }
+        }
+        log.debug('getting image parents with request:')
+        log.debug(pprint.pformat(data))
+        units = self._post('/pulp/api/v2/repositories/%s/search/units/' % repo,
+                           data=json.dumps(data))
+        return dict((unit['metadata']['image_id'], unit['metadata'].get('parent_id'))
+                    for unit in units)
+
     def getPrefix(self):
         """Return repository prefix."""
         return PREFIX
@@ -1477,23 +2311,24 @@ class Pulp(object):
 
     def getRepos(self, rids, fields=None, distributors=False):
         """Return list of repo objects with given IDs."""
-        data = {
-            "criteria": {
-                "filters": {
-                    "id": {"$in": rids}
+        def make_data(batch):
+            data = {
+                "criteria": {
+                    "filters": {
+                        "id": {"$in": batch}
+                    }
                 }
             }
-        }
 
-        if fields:
-            data["fields"] = fields
+            if fields:
+                data["fields"] = fields
 
-        if distributors:
-            data["distributors"] = distributors
+            if distributors:
+                data["distributors"] = distributors
+            return data
 
         log.debug('getting repositories %s', ', '.join(rids))
-        return self._post('/pulp/api/v2/repositories/search/',
-                          data=json.dumps(data))
+        return self._search_in('/pulp/api/v2/repositories/search/', rids, make_data)
 
     def getSignature(self, sig):
         """Return a signature key."""
@@ -1521,16 +2356,44 @@ class Pulp(object):
     def getTasks(self, tids):
         """Return a task report for a given id."""
         log.debug('getting tasks %s information' % tids)
+        return self._search_in(
+            '/pulp/api/v2/tasks/search/', tids,
+            lambda batch: {
+                "criteria": {
+                    "filters": {
+                        "task_id": {
+                            "$in": batch,
+                        }
+                    }
+                }
+            })
+
+    def getWorkers(self):
+        """Return the workers known to Pulp."""
+        log.debug('getting pulp workers')
+        return self._get('/pulp/api/v2/workers/')
+
+    def getQueueDepth(self):
+        """Return the number of tasks waiting or running in Pulp."""
         criteria = json.dumps({
             "criteria": {
                 "filters": {
-                    "task_id": {
-                        "$in": tids,
+                    "state": {
+                        "$in": ["waiting", "running"],
                     }
-                }
+                },
+                "fields": ["task_id", "state"],
             }
         })
-        return self._post('/pulp/api/v2/tasks/search/', data=criteria)
+        return len(self._post('/pulp/api/v2/tasks/search/', data=criteria))
+
+    def throttle(self):
+        """Return the Throttle bulk operations share, None if queue_target is unset."""
+        if not self.queue_target:
+            return None
+        if self._throttle is None:
+            self._throttle = Throttle(self, self.queue_target)
+        return self._throttle
 
     def isRedirect(self):
         return self.redirect
@@ -1824,17 +2687,20 @@ class Pulp(object):
             clean.sort(key=itemgetter('id'))
         return clean
 
-    def _collect_repo_units(self, repo_name, filter_unit=None, paginate=True):
+    def _collect_repo_units(self, repo_name, filter_unit=None, paginate=True, type_ids=None,
+                            fields=None):
         filter_unit = filter_unit or {}
 
         data = {
             'criteria': {
-                'type_ids': [V1_C_TYPE, V2_C_TYPE, V2_BLOB, V2_TAG, V2_LIST, SIG_TYPE],
+                'type_ids': type_ids or [V1_C_TYPE, V2_C_TYPE, V2_BLOB, V2_TAG, V2_LIST, SIG_TYPE],
                 'filters': {
                     'unit': filter_unit,
                 },
             }
         }
+        if fields:
+            data['criteria']['fields'] = {'unit': fields}
 
         log.debug('getting unit information with request:')
         log.debug(pprint.pformat(data))
@@ -1953,8 +2819,16 @@ class Pulp(object):
         if self._request.certificate:
             self._cleanup(os.path.dirname(self._request.certificate))
 
-    def remove(self, repo, img):
-        """Remove an image from a repo."""
+    def remove(self, repo, img, future=False):
+        """Remove an image from a repo.
+
+        img can also be a list of image IDs, digests and signatures. They
+        are removed with one unassociate request per content type and
+        BATCH_SIZE IDs, and the tasks are watched together.
+        """
+        self._forget_content_sources(repo)
+        if not isinstance(img, (six.text_type, six.binary_type)):
+            return self._removeMany(repo, img, future)
         if img.startswith("sha256:"):
             data = {
                 'criteria': {
@@ -2004,10 +2878,52 @@ class Pulp(object):
         tid = self._post(
             '/pulp/api/v2/repositories/%s/actions/unassociate/' % repo,
             data=json.dumps(data))
-        self.watch(tid)
-
-    def remove_filters(self, repo, filters={}, v1=True, v2=True):
+        return self._finish([tid], future)
+
+    def _removeMany(self, repo, imgs, future):
+        """Remove many IDs from a repo with few unassociate tasks."""
+        groups = (
+            ([V2_C_TYPE, V2_BLOB, V2_TAG, V2_LIST],
+             [i for i in imgs if i.startswith("sha256:")],
+             lambda batch: {"$or": [{'digest': {'$in': batch}},
+                                    {'manifest_digest': {'$in': batch}}]}),
+            ([SIG_TYPE],
+             [i for i in imgs if not i.startswith("sha256:") and '=' in i],
+             lambda batch: {'name': {'$in': batch}}),
+            ([V1_C_TYPE],
+             [i for i in imgs if not i.startswith("sha256:") and '=' not in i],
+             lambda batch: {'image_id': {'$in': batch}}),
+        )
+        throttle = self.throttle()
+        tids = []
+        for type_ids, ids, unit_filter in groups:
+            for batch in grouper(ids, int(BATCH_SIZE)):
+                batch = [i for i in batch if i is not None]
+                data = {
+                    'criteria': {
+                        'type_ids': type_ids,
+                        'filters': {
+                            'unit': unit_filter(batch)
+                        }
+                    },
+                    'override_config': {}
+                }
+                log.debug('removal request we are sending:')
+                log.debug(pprint.pformat(data))
+                log.info('removing %s units from %s' % (len(batch), repo))
+                if throttle is not None:
+                    throttle.admit()
+                tids.append(self._post(
+                    '/pulp/api/v2/repositories/%s/actions/unassociate/' % repo,
+                    data=json.dumps(data)))
+        if future:
+            return TaskFuture(self, tids)
+        if tids:
+            self.watch_tasks(tids)
+
+    def remove_filters(self, repo, filters={}, v1=True, v2=True, future=False):
         """Remove content from a repo according to filters."""
+        self._forget_content_sources(repo)
         type_ids = []
         if v1:
             type_ids.append(V1_C_TYPE)
@@ -2027,7 +2943,7 @@ class Pulp(object):
         tid = self._post(
             '/pulp/api/v2/repositories/%s/actions/unassociate/' % repo,
             data=json.dumps(data))
-        self.watch(tid)
+        return self._finish([tid], future)
 
     def searchRepos(self, patt):
         """Search and return Pulp repository IDs matching given pattern."""
@@ -2113,23 +3029,91 @@ class Pulp(object):
         manifest_lists = list(repoinfo['manifest_lists'])
         manifest_lists.sort()
 
-        # copy with filter to only select the new units
-        new_units = []
-        filters = {}
-        if imgs:
-            img_ids = {"image_id": {"$in": imgs}}
-            new_units.append(img_ids)
-        if manifests or manifest_lists:
-            digests = [manifest for manifest in manifests]
-            digests.extend([manifest_list for manifest_list in manifest_lists])
-            new_units.append({"manifest_digest": {"$in": digests}})
-        if new_units:
-            filters["unit"] = {"$or": new_units}
-            self.copy_filters(origin_repo, repo, filters)
+        # copy with filter to only select the new units, BATCH_SIZE of each at most
+        digests = manifests + manifest_lists
+        futures = []
+        for img_batch, digest_batch in zip_longest(grouper(imgs, int(BATCH_SIZE)),
+                                                   grouper(digests, int(BATCH_SIZE))):
+            new_units = []
+            if img_batch:
+                img_ids = {"image_id": {"$in": [i for i in img_batch if i is not None]}}
+                new_units.append(img_ids)
+            if digest_batch:
+                new_units.append({"manifest_digest": {
+                    "$in": [d for d in digest_batch if d is not None]}})
+            filters = {"unit": {"$or": new_units}}
+            futures.append(self.copy_filters(origin_repo, repo, filters, future=True))
+        if futures:
+            self.watch_futures(futures)
 
         return (imgs, manifests, manifest_lists)
 
-    def updateRepo(self, rid, update):
+    def syncRepos(self, env=None, repos=(), config_file=DEFAULT_CONFIG_FILE, feed=None,
+                  workers=4, **kwargs):
+        """Sync many repos, up to workers at a time.
+
+        Other keyword arguments are passed on to syncRepo. Each repo's new
+        units are copied to its origin repo as soon as its own sync ends;
+        the syncs in progress are polled together by the shared task
+        watcher. Returns a dict of repo to the syncRepo result. Repos that
+        fail do not stop the others; a DockPulpError naming them is raised
+        once all are done.
+        """
+        repos = list(repos)
+        if not feed:
+            self._getRepo(env, config_file)
+            feed = self.syncenv
+        failed = []
+
+        def sync(repo):
+            try:
+                return self.syncRepo(env, repo, config_file, feed=feed, **kwargs)
+            except errors.DockPulpError as e:
+                log.error('failed to sync %s: %s' % (repo, e))
+                failed.append(repo)
+
+        log.info('syncing %s repos, %s at a time' % (len(repos), workers))
+        pool = ThreadPool(max(1, min(workers, len(repos))))
+        try:
+            results = pool.map(sync, repos)
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            raise errors.DockPulpError('Failed to sync: %s' % ', '.join(sorted(failed)))
+        return dict(zip(repos, results))
+
+    def updateTags(self, rid, tags, future=False):
+        """Set the tags of many images in a repository at once.
+
+        "tags" is a dictionary of image IDs to their new list of tags; an
+        empty list removes the tags of that image. A tag moves to its new
+        image if another one had it. This is the same as an updateRepo
+        "tag" update per image, with one read, one write and one task.
+        """
+        log.info('updating tags of %s images in %s' % (len(tags), rid))
+        index = OrderedDict((e['tag'], e['image_id']) for e in self._getTags(rid))
+        for iid, new_tags in tags.items():
+            for tag in [tag for tag, image_id in index.items() if image_id == iid]:
+                del index[tag]
+            for tag in new_tags:
+                # re-inserted at the end, like updateRepo appends new tags
+                index.pop(tag, None)
+                index[tag] = iid
+        delta = {
+            'delta': {
+                'scratchpad': {
+                    'tags': [{'image_id': iid, 'tag': tag} for tag, iid in index.items()],
+                    'tags_updated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                }
+            }
+        }
+        log.debug('update request body: %s' % pprint.pformat(delta))
+        tid = self._put('/pulp/api/v2/repositories/%s/' % rid,
+                        data=json.dumps(delta))
+        return self._finish([tid], future)
+
+    def updateRepo(self, rid, update, future=False):
         """Update metadata on a repository.
 
         "update" is a dictionary of keys to update with new values
@@ -2176,7 +3160,11 @@ class Pulp(object):
             existing = [e for e in existing if e["tag"] not in new_tags and
                         e['image_id'] != iid]
             log.debug(existing)
-            delta['delta']['scratchpad'] = {'tags': existing}
+            # lets release --changed-only notice tag changes
+            delta['delta']['scratchpad'] = {
+                'tags': existing,
+                'tags_updated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            }
             if tags != '':
                 for tag in tags.split(','):
                     delta['delta']['scratchpad']['tags'].append(
@@ -2214,15 +3202,18 @@ class Pulp(object):
         log.debug('update request body: %s' % pprint.pformat(delta))
         tid = self._put('/pulp/api/v2/repositories/%s/' % rid,
                         data=json.dumps(delta))
-        self.watch(tid)
+        if not future:
+            self.watch(tid)
 
+        dist_tids = []
         if 'auto_publish' in update:
-            dist_tids = []
             for did in blob:
                 dist_tids.append(self.updateAutoPublish(rid, did['id'],
                                                         update['auto_publish'], watch=False))
-            for dtid in dist_tids:
-                self.watch(dtid)
+        if future:
+            return TaskFuture(self, [tid] + dist_tids)
+        for dtid in dist_tids:
+            self.watch(dtid)
 
     def updateAutoPublish(self, rid, dist_id, auto_publish, watch=True):
         if auto_publish not in [True, False]:
@@ -2237,17 +3228,253 @@ class Pulp(object):
             self.watch(tid)
         return tid
 
-    def upload(self, image, drepo=HIDDEN):
+    def upload(self, image, drepo=HIDDEN, reduce_layers=False, validate=None):
         """
         Upload an image to pulp. This does not associate it with any repository.
 
+        Layers already known to Pulp are not sent again. If every layer is
+        present the upload is skipped and the layers are only associated.
+        With reduce_layers, a tarball without the payload of the present
+        layers is uploaded instead of the original one. xz and bzip2
+        tarballs are transcoded to gzip on the fly.
+
+        validate is called with the image path in a separate thread while
+        the image is sent. If it raises, the transfer stops, the upload
+        request is deleted and the exception is re-raised.
+
         :param image: str, pathname
         """
         # TODO: support a hidden repo for "no-channel" style uploads
-        metadata = imgutils.get_metadata(image)
-        newimgs = list(imgutils.get_metadata_pulp(metadata).keys())
+        pool = ThreadPool(1)
+        try:
+            validation = None
+            if validate is not None:
+                validation = pool.apply_async(validate, (image,))
+            metadata = imgutils.get_metadata(image)
+            pulp_md = imgutils.get_metadata_pulp(metadata)
+            newimgs = list(pulp_md.keys())
+            iid = imgutils.get_top_layer(pulp_md)
+            present = set(self.getImageIdsExist(newimgs))
+            origin_drepo = self._uploadOriginRepo(drepo)
+            if present.issuperset(newimgs):
+                if validation is not None:
+                    validation.get()
+                log.info('all layers of %s are already in pulp, skipping upload' % iid)
+                self._associatePresent(iid, newimgs, drepo, origin_drepo)
+            else:
+                if present:
+                    log.info('%s of %s layers are already in pulp' % (len(present), len(newimgs)))
+                skip_ids = present if reduce_layers else set()
+                self._uploadImage(image, iid, skip_ids, drepo, origin_drepo,
+                                  validation=validation)
+        finally:
+            pool.close()
+            pool.join()
+        # use filter to copy all new images
+        pulp_filter = {'unit': {
+            '$or': [{'image_id': img} for img in newimgs]}}
+        self.copy_filters(drepo, source=origin_drepo, filters=pulp_filter, v1=True, v2=False)
+
+    def upload_many(self, images, drepo=HIDDEN, workers=4, validate=None):
+        """Upload several tarballs to pulp concurrently, sending shared layers once.
+
+        The tarballs are indexed in parallel. Every layer that is not in Pulp
+        yet is sent with only one of the tarballs that contain it; the other
+        tarballs are uploaded without its payload, like with
+        upload(reduce_layers=True), once the tarball sending it has been
+        uploaded and imported, and not at all if that failed. Tarballs with
+        nothing new are only associated. validate is run on every tarball alongside the transfers,
+        as in upload(). Returns a dict of tarball path to a result dict with
+        the top image_id, the uploaded layers and an error message or None.
+        """
+        pool = ThreadPool(workers)
+        checks = ThreadPool(workers)
+        try:
+            validations = {}
+            if validate is not None:
+                for image in images:
+                    validations[image] = checks.apply_async(validate, (image,))
+            index = dict(zip(images, pool.map(self._indexImage, images)))
+            all_ids = set()
+            for pulp_md in index.values():
+                all_ids.update(pulp_md)
+            present = set(self.getImageIdsExist(sorted(all_ids)))
+            log.info('%s unique layers in %s tarballs, %s already in pulp' %
+                     (len(all_ids), len(images), len(present & all_ids)))
+            owner = {}
+            for image in images:
+                for layer in index[image]:
+                    if layer not in present:
+                        owner.setdefault(layer, image)
+            origin_drepo = self._uploadOriginRepo(drepo)
+            if drepo != HIDDEN:
+                self.createOriginRepo(drepo)
+            throttle = self.throttle()
+
+            def upload_one(image):
+                pulp_md = index[image]
+                iid = imgutils.get_top_layer(pulp_md)
+                own = set(layer for layer in pulp_md if owner.get(layer) == image)
+                validation = validations.get(image)
+                result = {'image_id': iid, 'uploaded': sorted(own), 'error': None}
+                missing = sorted(layer for layer in pulp_md
+                                 if owner.get(layer, image) != image and
+                                 results[owner[layer]]['error'])
+                if missing:
+                    result['error'] = 'layers sent with a failed tarball: %s' % ', '.join(missing)
+                    return result
+                try:
+                    if throttle is not None:
+                        throttle.admit()
+                    if not own and validation is not None:
+                        validation.get()
+                    if not own and present.issuperset(pulp_md):
+                        log.info('all layers of %s are already in pulp' % image)
+                        self._associatePresent(iid, list(pulp_md), drepo, origin_drepo)
+                    elif not own:
+                        # every new layer is sent by another tarball
+                        log.info('all new layers of %s are sent with other tarballs' % image)
+                    else:
+                        self._uploadImage(image, iid, set(pulp_md) - own, drepo, origin_drepo,
+                                          validation=validation)
+                except Exception as e:
+                    log.error('uploading %s failed: %s' % (image, e))
+                    result['error'] = str(e) or e.__class__.__name__
+                return result
+
+            # A tarball without the payload of a layer is only imported after
+            # the one sending that layer, which always comes earlier in images,
+            # so that Pulp never creates the layer from the reduced metadata.
+            results = {}
+            remaining = list(images)
+            while remaining:
+                wave = [image for image in remaining
+                        if all(owner.get(layer, image) == image or owner[layer] in results
+                               for layer in index[image])]
+                remaining = [image for image in remaining if image not in wave]
+                results.update(zip(wave, pool.map(upload_one, wave)))
+        finally:
+            for p in (pool, checks):
+                p.close()
+                p.join()
+        uploaded = set()
+        for image, result in results.items():
+            if result['error'] is None:
+                uploaded.update(index[image])
+        if uploaded:
+            pulp_filter = {'unit': {
+                '$or': [{'image_id': img} for img in sorted(uploaded)]}}
+            self.copy_filters(drepo, source=origin_drepo, filters=pulp_filter,
+                              v1=True, v2=False)
+        return results
+
+    def _indexImage(self, image):
+        """Return the layer metadata of a tarball, as get_metadata_pulp does."""
+        return imgutils.get_metadata_pulp(imgutils.get_metadata(image))
+
+    def _associatePresent(self, iid, newimgs, drepo, origin_drepo):
+        """Associate layers that are all in pulp already with the origin repo."""
+        if drepo != HIDDEN:
+            self.createOriginRepo(drepo)
+        source = self._find_content_source(iid, 'image_id', [V1_C_TYPE])
+        if source != origin_drepo:
+            pulp_filter = {'unit': {
+                '$or': [{'image_id': img} for img in newimgs]}}
+            self.copy_filters(origin_drepo, source=source, filters=pulp_filter,
+                              v1=True, v2=False)
+
+    def _uploadImage(self, image, iid, skip_ids, drepo, origin_drepo, validation=None):
+        """Upload a tarball, leaving out the layer payloads in skip_ids."""
+        if skip_ids:
+            with tempfile.TemporaryFile() as fobj:
+                skipped = imgutils.filter_layers(image, fobj, skip_ids)
+                log.info('left %s layers out of the uploaded tarball' % skipped)
+                size = fobj.tell()
+                fobj.seek(0)
+                self._upload(fobj, size, iid, os.path.basename(image), drepo, origin_drepo,
+                             validation=validation)
+            return
+        filename = os.path.basename(image)
+        compression = imgutils.get_compression(image)
+        with open(image, 'rb') as fobj:
+            transcoder = None
+            if compression in ('xz', 'bzip2'):
+                # Pulp can only extract gzip, size is unknown until the end
+                log.info('transcoding %s image to gzip while uploading' % compression)
+                transcoder = fobj = imgutils.GzipTranscoder(fobj, compression)
+                filename = re.sub(r'\.(xz|bz2)$', '.gz', filename)
+                size = None
+            else:
+                size = int(os.path.getsize(image))
+            try:
+                self._upload(fobj, size, iid, filename, drepo, origin_drepo,
+                             validation=validation)
+            finally:
+                if transcoder is not None:
+                    # stop reading the file before it is closed, also if the upload failed
+                    transcoder.close()
+
+    def upload_stream(self, fobj, drepo=HIDDEN, filename='image.tar', validate=None):
+        """Upload an image read once from a stream, such as stdin.
+
+        The tarball is inspected while it is sent, nothing is written to
+        disk. validate is called with the imgutils.StreamInspector after the
+        last chunk and before the import; if it raises, the upload request
+        is deleted and the image is not imported.
+        """
+        inspector = imgutils.StreamInspector(fobj)
         rid = self._createUploadRequest()
-        size = int(os.path.getsize(image))
+        imported = False
+        try:
+            size = self._uploadChunks(rid, inspector)
+            inspector.close()
+            if validate is not None:
+                validate(inspector)
+            pulp_md = imgutils.get_metadata_pulp(inspector.get_metadata())
+            newimgs = list(pulp_md.keys())
+            iid = imgutils.get_top_layer(pulp_md)
+            origin_drepo = self._uploadOriginRepo(drepo)
+            self._importUpload(rid, size, iid, filename, drepo, origin_drepo)
+            imported = True
+        finally:
+            if not imported:
+                self._deleteUploadRequest(rid)
+        pulp_filter = {'unit': {
+            '$or': [{'image_id': img} for img in newimgs]}}
+        self.copy_filters(drepo, source=origin_drepo, filters=pulp_filter, v1=True, v2=False)
+
+    def _uploadOriginRepo(self, drepo):
+        """Return the repo uploads for drepo are imported into."""
+        if drepo != HIDDEN and not drepo.startswith(ORIGIN_PREFIX):
+            return ORIGIN_PREFIX + drepo
+        return drepo
+
+    def _upload(self, fobj, size, iid, filename, drepo, origin_drepo, validation=None):
+        """Send an open tarball to pulp and import it into the origin repo.
+
+        validation is an AsyncResult of a check running alongside the
+        transfer; the image is only imported once it succeeded.
+        """
+        rid = self._createUploadRequest()
+        try:
+            size = self._uploadChunks(rid, fobj, size, validation=validation)
+            if validation is not None:
+                if not validation.ready():
+                    log.info('waiting for the image validation to finish')
+                validation.get()
+        except Exception:
+            self._deleteUploadRequest(rid)
+            raise
+        self._importUpload(rid, size, iid, filename, drepo, origin_drepo)
+
+    def _uploadChunks(self, rid, fobj, size=None, validation=None):
+        """Send the content of fobj in chunks, return the number of bytes sent.
+
+        Without a size, fobj is read until it is exhausted. If chunk_size_max
+        is configured, the chunk size adapts to the measured throughput. If
+        the validation AsyncResult completed with an error, it is raised
+        before the next chunk is sent.
+        """
         curr = 0
         mb = 1024 * 1024  # 1M
         try:
@@ -2260,17 +3487,42 @@ class Pulp(object):
         except AttributeError:
             # chunk size defaults to 1 MB if not set
             block = mb
-        log.info('uploading a %sM image' % (size / mb,))
-        log.debug('using a chunk size of %sM' % (block / mb,))
-        with open(image) as fobj:
-            while curr < size:
-                data = fobj.read(block)
-                self._put('/pulp/api/v2/content/uploads/%s/%s/' % (rid, curr),
-                          data=data)
-                curr += len(data)
-                log.debug('%s/%s bytes sent' % (curr, size))
+        maximum = block
+        if self.chunk_size_max:
+            maximum = max(block, self.chunk_size_max * mb)
+        minimum = min(block, (self.chunk_size_min or 1) * mb)
+        sizer = ChunkSizer(block, minimum, maximum)
+        if size is None:
+            log.info('uploading an image of unknown size')
+        else:
+            log.info('uploading a %sM image' % (size / mb,))
+        if maximum > block:
+            log.debug('using an adaptive chunk size of %sM to %sM, starting at %sM' %
+                      (minimum / mb, maximum / mb, block / mb))
+        else:
+            log.debug('using a chunk size of %sM' % (block / mb,))
+        reader = ChunkReader(fobj, maximum)
+        while size is None or curr < size:
+            if validation is not None and validation.ready():
+                # raises if the image turned out to be invalid
+                validation.get()
+            data = reader.read(sizer.size)
+            if not data:
+                break
+            start = time.time()
+            self._put('/pulp/api/v2/content/uploads/%s/%s/' % (rid, curr),
+                      data=data)
+            sizer.update(len(data), time.time() - start)
+            curr += len(data)
+            log.debug('%s/%s bytes sent' % (curr, size))
         log.info('content uploaded')
-        iid = imgutils.get_id(image)
+        log.info('sent %sM in %s chunks in %.1f seconds (%.2fM/s)' %
+                 (curr / mb, sizer.chunks, sizer.elapsed, sizer.throughput() / mb))
+        return curr
+
+    def _importUpload(self, rid, size, iid, filename, drepo, origin_drepo):
+        """Import an upload request into the origin repo and delete the request."""
+        mb = 1024 * 1024  # 1M
         data = {
             # type_id is from pulp_docker.common.constants.IMAGE_TYPE_ID
             'unit_type_id': V1_C_TYPE,
@@ -2278,13 +3530,9 @@ class Pulp(object):
             'unit_key': {'image_id': iid},
             'unit_metadata': {
                 'checksum_type': None,
-                'filename': os.path.basename(image)
+                'filename': filename
             }
         }
-        if drepo != HIDDEN and not drepo.startswith(ORIGIN_PREFIX):
-            origin_drepo = ORIGIN_PREFIX + drepo
-        else:
-            origin_drepo = drepo
         if drepo != HIDDEN:
             self.createOriginRepo(drepo)
         log.info('adding %s to %s' % (iid, origin_drepo))
@@ -2296,37 +3544,184 @@ class Pulp(object):
         timer = max(self.timeout, (size / mb) * 2)  # wait 2 seconds per megabyte, or timeout,
         self.watch(tid, timeout=timer)  # whichever is greater
         self._deleteUploadRequest(rid)
-        # use filter to copy all new images
-        pulp_filter = {'unit': {
-            '$or': [{'image_id': img} for img in newimgs]}}
-        self.copy_filters(drepo, source=origin_drepo, filters=pulp_filter, v1=True, v2=False)
 
-    def watch(self, tid, timeout=None, poll=5):
-        """Watch a task ID and return task report when it finishes or fails."""
+    def _pollIntervals(self, poll=None):
+        """Return the PollInterval to watch tasks with.
+
+        An explicit poll in seconds gives a fixed interval, otherwise the
+        configured curve is used. With the event listener running, the curve
+        goes up to event_poll seconds instead, since syncs and publishes
+        wake the watcher when they end; other tasks send no events and are
+        still noticed by polling.
+        """
+        if poll is not None:
+            return PollInterval.fixed(poll)
+        if self.events is not None:
+            return PollInterval(self.poll_initial, max(self.poll_max, self.event_poll),
+                                self.poll_factor)
+        return PollInterval(self.poll_initial, self.poll_max, self.poll_factor)
+
+    def startEventListener(self, url=None):
+        """Have Pulp notify a local HTTP receiver when syncs and publishes end.
+
+        url is where Pulp can reach this host, it defaults to the
+        event_listener setting. Watched tasks are then polled again as soon
+        as an event arrives, and otherwise on a curve that goes up to
+        event_poll seconds. The listener is removed at exit; listeners for
+        the same url left behind by a process that was killed are removed
+        here, as the receiver now owns that port.
+        """
+        with self._events_lock:
+            if self.events is not None:
+                return
+            receiver = TaskEventReceiver(self.watcher, url or self.event_listener)
+            data = {
+                'notifier_type_id': 'http',
+                'notifier_config': {'url': receiver.url},
+                'event_types': TASK_EVENT_TYPES,
+            }
+            try:
+                self.removeEventListeners(receiver.url)
+                listener = self._post('/pulp/api/v2/events/', data=json.dumps(data))
+            except Exception:
+                receiver.close()
+                raise
+            self.listener_id = listener['id']
+            self.events = receiver
+            atexit.register(self.stopEventListener)
+            log.info('registered pulp event listener %s' % self.listener_id)
+
+    def stopEventListener(self):
+        """Unregister the event listener and stop the receiver."""
+        with self._events_lock:
+            if self.events is None:
+                return
+            log.info('removing pulp event listener %s' % self.listener_id)
+            try:
+                self._delete('/pulp/api/v2/events/%s/' % self.listener_id)
+            finally:
+                self.events.close()
+                self.events = None
+
+    def removeEventListeners(self, url):
+        """Unregister every Pulp event listener that notifies url."""
+        for listener in self._get('/pulp/api/v2/events/'):
+            if (listener.get('notifier_type_id') == 'http' and
+                    listener.get('notifier_config', {}).get('url') == url):
+                log.info('removing stale pulp event listener %s' % listener['id'])
+                self._delete('/pulp/api/v2/events/%s/' % listener['id'])
+
+    def _useEventListener(self):
+        """Start the configured event listener, fall back to polling if it fails."""
+        if not self.event_listener or self.events is not None:
+            return
+        with self._events_lock:
+            # another thread may have started it, or given up, meanwhile
+            if not self.event_listener or self.events is not None:
+                return
+            try:
+                self.startEventListener()
+            except Exception as e:
+                log.warning('could not start the event listener, polling instead: %s' % e)
+                self.event_listener = None
+
+    def _finish(self, task_ids, future):
+        """Return a TaskFuture for the tasks, or wait for them if future is False."""
+        if future:
+            return TaskFuture(self, task_ids)
+        for tid in task_ids:
+            self.watch(tid)
+
+    def watch_futures(self, futures, timeout=None):
+        """Wait for many TaskFutures at once with a single watch_tasks call.
+
+        Returns the futures. If any task fails, watch_tasks cancels the
+        others and raises; the result() of a future whose tasks were not all
+        reported waits for them again and raises for the failed ones. A
+        future with a failed task raises DockPulpTaskError from result().
+        """
+        pending = [f for f in futures if f._reports is None and f._error is None]
+        task_ids = set()
+        for f in pending:
+            task_ids.update(f.task_ids)
+        ended = self.watch_tasks(sorted(task_ids), timeout=timeout)
+        reports = dict((t['task_id'], t) for t in ended)
+        error = None
+        for f in pending:
+            f._reports = [reports[tid] for tid in f.task_ids]
+            failed = [t['task_id'] for t in f._reports if not self.is_task_successful(t)]
+            if failed:
+                f._reports = None
+                f._error = errors.DockPulpTaskError('Pulp tasks failed: %s' % ', '.join(failed))
+                error = error or f._error
+        if error is not None:
+            raise error
+        return futures
+
+    def _pollTasks(self, task_ids):
+        """Fetch the tasks once, return a dict of ID to report of those that ended.
+
+        A task that cannot be fetched on its own, such as an unknown ID, maps
+        to the exception raised instead of a report. Errors of the search
+        for many tasks are raised.
+        """
+        failed = {}
+        tasks = {}
+        if len(task_ids) > 1:
+            tasks = dict((t["task_id"], t) for t in self.getTasks(list(task_ids)))
+        # some tasks could be already removed from cache - search_tasks
+        # doesn't find them. Need check manually
+        for task_id in set(task_ids) - set(tasks):
+            try:
+                tasks[task_id] = self.getTask(task_id)
+            except Exception as e:
+                log.debug('getting task %s failed: %s' % (task_id, e))
+                failed[task_id] = e
+        ended = dict((tid, t) for tid, t in tasks.items() if t["state"] in TASK_END_STATES)
+        ended.update(failed)
+        return ended
+
+    def watch(self, tid, timeout=None, poll=None):
+        """Watch a task ID and return task report when it finishes or fails.
+
+        The task is polled by the shared TaskWatcher together with the tasks
+        other threads wait on. With a fixed poll interval, the task is polled
+        on its own and timeout counts the time slept instead.
+        """
         if timeout is None:
             timeout = self.timeout
         log.info('waiting up to %s seconds for task %s...' % (timeout, tid))
+        if poll is None:
+            self._useEventListener()
+            t = self.watcher.wait([tid], timeout).get(tid)
+        else:
+            t = self._watchPolling(tid, timeout, poll)
+        if t is None:
+            log.error('timed out waiting for subtask')
+            raise errors.DockPulpError('Timed out waiting for task %s' % tid)
+        if t['state'] == 'finished':
+            log.info('subtask completed')
+            return t
+        elif t['state'] == 'error':
+            log.debug('traceback from subtask:')
+            log.debug(t['traceback'])
+            raise errors.DockPulpTaskError(t['error'])
+        elif t['state'] == 'skipped':
+            log.info('subtask skipped')
+            return t
+        raise errors.DockPulpError('subtask canceled')
+
+    def _watchPolling(self, tid, timeout, poll):
+        """Poll a task every poll seconds, return it once it ended or None."""
         curr = 0
         while curr < timeout:
             t = self.getTask(tid)
-            if t['state'] == 'finished':
-                log.info('subtask completed')
+            if t['state'] in TASK_END_STATES:
                 return t
-            elif t['state'] == 'error':
-                log.debug('traceback from subtask:')
-                log.debug(t['traceback'])
-                raise errors.DockPulpTaskError(t['error'])
-            elif t['state'] == 'skipped':
-                log.info('subtask skipped')
-                return t
-            elif t['state'] == 'canceled':
-                raise errors.DockPulpError('subtask canceled')
-            else:
-                log.debug('sleeping (%s/%s seconds passed)' % (curr, timeout))
-                time.sleep(poll)
-                curr += poll
-        log.error('timed out waiting for subtask')
-        raise errors.DockPulpError('Timed out waiting for task %s' % tid)
+            log.debug('sleeping (%s/%s seconds passed)' % (curr, timeout))
+            time.sleep(poll)
+            curr += poll
+        return None
 
     def is_task_successful(self, task):
         # Try to inspect task results to catch buried failures
@@ -2368,11 +3763,12 @@ class Pulp(object):
             repo = repo.replace("pulp:repository:", "")
             return "Importing content to repo %s" % (repo)
 
-    def watch_tasks(self, task_ids, timeout=None, poll=5):
+    def watch_tasks(self, task_ids, timeout=None, poll=None):
         """Wait for all supplied task ids to complete.
 
         Doesn't wait for other tasks if at least one fails,
-        just cancel everything running and raise error.
+        just cancel everything running and raise error. Raises as well
+        when the failed task is the last one to end.
         """
         running = set(task_ids)
         running_count = len(running)
@@ -2385,28 +3781,23 @@ class Pulp(object):
         if running:
             log.debug("Waiting on the following %d Pulp tasks: %s" % (
                 len(running), ",".join(sorted(running))))
+        if poll is None:
+            self._useEventListener()
         while running:
-            time.sleep(poll)
-            tasks_found = self.getTasks(list(running))
-            finished = [t for t in tasks_found if t["state"] in ("finished", "error", "canceled")]
+            if poll is None:
+                finished = list(self.watcher.wait(sorted(running)).values())
+            else:
+                time.sleep(poll)
+                finished = list(self._pollTasks(sorted(running)).values())
+            for t in finished:
+                if isinstance(t, Exception):
+                    raise t
             for t in finished:
                 if self.is_task_successful(t):
                     log.debug("Task successful: %s, %s" % (t["task_id"], self.resolve_task_type(t)))
                 else:
                     log.debug("Finished: Failed: %s" % (t))
                 results[t["task_id"]] = t
-            # some tasks could be already removed from cache - search_tasks
-            # doesn't find them. Need check manually
-            for task_id in set(running) - set([t["task_id"] for t in tasks_found]):
-                task = self.getTask(task_id)
-                if task["state"] in ("finished", "error", "canceled"):
-                    results[task["task_id"]] = task
-                    if self.is_task_successful(task):
-                        log.debug("Task successful: %s, %s" % (task["task_id"],
-                                  self.resolve_task_type(task)))
-                    else:
-                        log.debug("Finished: Failed: %s" % (task))
-                    finished.append(t)
             for t in [t for t in finished if not self.is_task_successful(t)]:
                 if t.get("exception", None):
                     exception = ''.join(t["exception"])
@@ -2432,10 +3823,11 @@ class Pulp(object):
                 failed = True
             running -= set([t["task_id"] for t in finished])
 
-            if failed and running:
-                log.warning("Canceling running tasks: %s" % ', '.join(running))
-                for task_id in running:
-                    self.deleteTask(task_id)
+            if failed:
+                if running:
+                    log.warning("Canceling running tasks: %s" % ', '.join(running))
+                    for task_id in running:
+                        self.deleteTask(task_id)
                 running = set()
                 raise errors.DockPulpError("Pulp tasks failed: %s" % failed_tasks)
 
@@ -243,15 +243,12 @@ def do_clone(bopts, bargs, parser):
                  protected=get_bool_from_string(oldinfo['protected']), distribution=dist,
                  productline=productid, prefix_with=prefix_with)
     log.info('cloning content in %s to %s' % (args[0], repoid))
+    content = list(oldinfo['images']) + list(oldinfo['manifests'])
+    if len(content) > 0:
+        p.copyMany(repoid, content)
     if len(oldinfo['images']) > 0:
-        for img in oldinfo['images']:
-            p.copy(repoid, img)
-            tags = {'tag': '%s:%s' % (','.join(oldinfo['images'][img]), img)}
-            p.updateRepo(repoid, tags)
-    if len(oldinfo['manifests']) > 0:
-        for manifest in oldinfo['manifests']:
-            p.copy(repoid, manifest)
-    if len(oldinfo['images']) == 0 and len(oldinfo['manifests']) == 0:
+        p.updateTags(repoid, dict(oldinfo['images']))
+    if len(content) == 0:
         log.info('no content to copy in')
     log.info('cloning complete')
 
@@ -321,9 +318,8 @@ def do_copy(bopts, bargs, parser):
     if len(args) < 2:
         parser.error('You must provide a destination repository and image-id')
     p = pulp_login(bopts)
-    for img in args[1:]:
-        p.copy(args[0], img, opts.source)
-        log.info('copying successful')
+    p.copyMany(args[0], args[1:], opts.source)
+    log.info('copying successful')
 
 
 @make_parser
@@ -447,6 +443,44 @@ def do_empty(bopts, bargs, parser):
         p.emptyRepo(repo)
 
 
+@make_parser
+def do_gc(bopts, bargs, parser):
+    """Find layers and blobs no tag in the environment needs, and remove them.
+
+    dock-pulp gc --plan [--manifests]
+    dock-pulp gc --remove [--manifests]
+    """
+    parser.add_option('-p', '--plan', default=False, action='store_true',
+                      help='list the units that would be removed')
+    parser.add_option('-r', '--remove', default=False, action='store_true',
+                      help='remove the units and clean up orphans. USE WITH CAUTION')
+    parser.add_option('-m', '--manifests', default=False, action='store_true',
+                      help='also remove untagged manifests and manifest lists; '
+                      'they can no longer be pulled by digest')
+    parser.add_option('-j', '--workers', default=4, type='int',
+                      help='number of repositories to collect units from at once')
+    parser.add_option('--no-paginate', default=False, action='store_true',
+                      help='retrieve all repo content at once without pagination')
+    opts, args = parser.parse_args(bargs)
+    if len(args) != 0:
+        parser.error('gc takes no arguments')
+    if not opts.plan and not opts.remove:
+        parser.error('You must specify --plan or --remove')
+    p = pulp_login(bopts)
+    plan = p.getGarbagePlan(workers=opts.workers, manifests=opts.manifests,
+                            paginate=not opts.no_paginate)
+    if not plan:
+        log.info('No unneeded content found')
+    for repo in sorted(plan):
+        log.info('%s:' % repo)
+        for unit in plan[repo]:
+            log.info('  %s' % unit)
+    if opts.remove and plan:
+        log.info('removing unneeded content')
+        p.collectGarbage(plan, manifests=opts.manifests)
+        log.info('Unneeded content removed')
+
+
 @make_parser
 def do_imageids(bopts, bargs, parser):
     """List all layers existing on server.
@@ -732,12 +766,23 @@ def do_release(bopts, bargs, parser):
                       help='use force_full for release')
     parser.add_option('-d', '--delete', '-r', '--force-refresh', default=False, action='store_true',
                       dest="delete", help='removes extra content on filer that is not in pulp')
+    parser.add_option('-j', '--concurrency', type='int',
+                      help='number of repos to publish at once [default: from config, or 4]')
+    parser.add_option('-c', '--changed-only', default=False, action='store_true',
+                      help='only publish repos that changed since they were last published')
     opts, args = parser.parse_args(bargs)
     p = pulp_login(bopts)
     if p.env == 'prod':
         log.warning('Releasing to production! Customers will see this!')
-    if len(args) == 0:
-        p.crane()
+    if len(args) == 0 and opts.changed_only:
+        rids = p.getStaleRepoIDs()
+        if not rids:
+            log.info('no repos changed since they were last published')
+            return
+        p.crane(repos=rids, skip=opts.force_full, force_refresh=opts.delete,
+                concurrency=opts.concurrency)
+    elif len(args) == 0:
+        p.crane(concurrency=opts.concurrency)
     else:
         rids = []
         for arg in args:
@@ -750,7 +795,13 @@ def do_release(bopts, bargs, parser):
                     rids.extend(results)
             else:
                 rids.append(arg)
-        p.crane(repos=rids, skip=opts.force_full, force_refresh=opts.delete)
+        if opts.changed_only:
+            rids = p.getStaleRepoIDs(rids)
+            if not rids:
+                log.info('no repos changed since they were last published')
+                return
+        p.crane(repos=rids, skip=opts.force_full, force_refresh=opts.delete,
+                concurrency=opts.concurrency)
     log.info('pulp configuration(s) successfully exported')
 
 
@@ -820,8 +871,7 @@ def do_remove(bopts, bargs, parser):
     if len(args) < 2:
         parser.error('You must provide a repo and image-id')
     p = pulp_login(bopts)
-    for img in args[1:]:
-        p.remove(args[0], img)
+    p.remove(args[0], args[1:] if len(args) > 2 else args[1])
     if args[0] == dockpulp.HIDDEN:
         log.info('removed images')
         sys.exit(0)
@@ -834,50 +884,72 @@ def do_remove(bopts, bargs, parser):
         sys.exit(0)
     ancestors = set()
     log.debug('tagged images: %s' % tagged_images)
+    ancestry = p.getAncestry(sorted(tagged_images), parents=p.getImageParents(args[0]))
     for tagged_image in tagged_images:
-        ancestors.update(set(p.getAncestors(tagged_image)))
+        ancestors.update(ancestry[tagged_image])
     log.debug('ancestors of tagged images: %s' % ancestors)
     unneeded = set(images.keys()) - ancestors - tagged_images
     log.debug('removing: %s' % unneeded)
-    for img in unneeded:
-        p.remove(args[0], img)
+    if unneeded:
+        p.remove(args[0], sorted(unneeded))
     log.info('removed images and unneeded layers')
 
 
 @make_parser
 def do_sync(bopts, bargs, parser):
-    """Sync a repo from one environment to another.
+    """Sync repos from one environment to another.
 
     dock-pulp sync [options] <env to sync from> repo-id
+    dock-pulp sync [options] --from <env to sync from> repo-id [repo-id...]
+    dock-pulp sync [options] --from <env to sync from> --file repo-list
     """
     parser.add_option('-p', '--password', help='specify a password')
     parser.add_option('-u', '--username', help='specify a username')
     parser.add_option('--upstream', help='specify an upstream name docker id to sync from')
     parser.add_option('--feed', help='specify an upstream feed url to sync from')
+    parser.add_option('--from', dest='env', help='specify an environment to sync from')
+    parser.add_option('-f', '--file', help='read repo ids to sync from a file, one per line')
+    parser.add_option('-j', '--workers', default=4, type='int',
+                      help='number of repos to sync at once')
     parser.add_option('-s', '--sslvalidation', help='Use SSL validation', default=False,
                       action='store_true',)
     parser.add_option('--no-paginate', default=False, action='store_true',
                       help='retrieve all repo content at once without pagination')
     opts, args = parser.parse_args(bargs)
-    if len(args) < 2 and opts.feed is None:
-        parser.error('You must provide an environment to sync from and a repo id')
-    elif len(args) < 1:
+    if opts.env is None and opts.feed is None:
+        if len(args) < 2:
+            parser.error('You must provide an environment to sync from and a repo id')
+        env = args[0]
+        repos = args[1:]
+    else:
+        env = opts.env
+        repos = args
+    if opts.file:
+        with open(opts.file) as f:
+            repos.extend(line.strip() for line in f
+                         if line.strip() and not line.startswith('#'))
+    if len(repos) < 1:
         parser.error('You must provide a repo id')
+    if opts.upstream and len(repos) > 1:
+        parser.error('--upstream can only be used with a single repo')
     p = pulp_login(bopts)
-    if opts.feed:
-        env = None
-        repo = args[0]
+
+    kwargs = dict(feed=opts.feed,
+                  basic_auth_username=opts.username,
+                  basic_auth_password=opts.password,
+                  ssl_validation=opts.sslvalidation,
+                  paginate=not opts.no_paginate)
+    if len(repos) == 1:
+        results = {repos[0]: p.syncRepo(env, repos[0], bopts.config_file,
+                                        upstream_name=opts.upstream, **kwargs)}
     else:
-        env = args[0]
-        repo = args[1]
+        results = p.syncRepos(env, repos, bopts.config_file, workers=opts.workers, **kwargs)
+
+    for repo in repos:
+        _print_sync_result(repo, *results[repo])
 
-    imgs, manifests, manifest_lists = p.syncRepo(env, repo, bopts.config_file, feed=opts.feed,
-                                                 basic_auth_username=opts.username,
-                                                 basic_auth_password=opts.password,
-                                                 ssl_validation=opts.sslvalidation,
-                                                 upstream_name=opts.upstream,
-                                                 paginate=not opts.no_paginate)
 
+def _print_sync_result(repo, imgs, manifests, manifest_lists):
     log.info(repo)
     log.info('-' * len(repo))
     log.info('synced images:')
@@ -1026,17 +1098,92 @@ def do_update(bopts, bargs, parser):
         log.info('repo successfully updated')
 
 
+def _check_image(manifest, r_chk):
+    """Log why an image does not conform to Pulp requirements.
+
+    Takes the image manifest and the result of the repositories check,
+    returns the exit status to use, or 0 if the image is fine.
+    """
+    vers = dockpulp.imgutils.get_versions(manifest)
+    good = True
+    for id, version in vers.items():
+        minor = int(version[2:version.index('.', 2)])
+        if version.startswith('0') and minor < 10:
+            log.error('Ancient docker version detected in layer')
+            log.error('  %s (%s)' % (id, version))
+            good = False
+    if not good:
+        log.error('Layer(s) in the image were created with an unsupported')
+        log.error('version of docker, you cannot upload this image. Dev')
+        log.error('needs to rebuild it with only supported versions at every')
+        log.error('layer.')
+        return 1
+    if r_chk == 1:
+        log.error('Image is missing a "repositories" file in the root of the')
+        log.error('tarball filesystem. Engineering needs to rebuild it with')
+        log.error('exactly 1 repository defined.')
+        return 2
+    elif r_chk == 2:
+        log.error('Pulp demands exactly one repository defined in the')
+        log.error('"repositories" file, Engineering needs to rebuild it with')
+        log.error('exactly 1 repository defined.')
+        return 3
+    elif r_chk == 3:
+        log.error('The "repositories" file references images that are not a')
+        log.error('part of the tarball itself. Uploading this will yield')
+        log.error('inconsistent repository metadata, so it is forbidden.')
+        log.error('Make sure Engineering saved it with "docker save id:TAG"')
+        return 4
+    return 0
+
+
+class ImageCheckError(Exception):
+    """An image does not conform to Pulp requirements."""
+
+    def __init__(self, status):
+        super(ImageCheckError, self).__init__('image check failed (status %s)' % status)
+        self.status = status
+
+
+def _log_layers(metadata):
+    newimgs = list(dockpulp.imgutils.get_metadata_pulp(metadata).keys())
+    log.info('Layers in this tarball:')
+    for img in newimgs:
+        log.info('  %s' % img)
+
+
+def _validate_image(image):
+    # called by Pulp.upload in a separate thread while the image is sent
+    manifest = dockpulp.imgutils.get_manifest(image)
+    _log_layers(dockpulp.imgutils.get_metadata(image))
+    status = _check_image(manifest, dockpulp.imgutils.check_repo(image))
+    if status:
+        raise ImageCheckError(status)
+
+
+def _validate_stream(inspector):
+    # called by Pulp.upload_stream once the whole image went through
+    _log_layers(inspector.get_metadata())
+    status = _check_image(inspector.get_manifest(), inspector.check_repo())
+    if status:
+        raise ImageCheckError(status)
+
+
 @make_parser
 def do_upload(bopts, bargs, parser):
     """Upload an image to a pulp repository.
 
     dock-pulp upload image-path repo-id
+    dock-pulp upload image-path image-path [image-path...] repo-id
+    dock-pulp upload - repo-id < image.tar
     dock-pulp upload --list-uploads [--delete]
     """
     parser.add_option('-l', '--list-uploads', default=False, action='store_true',
                       help='List all upload request IDs')
     parser.add_option('-r', '--remove', default=False, action='store_true',
                       help='Delete all outstanding upload reuqests. USE WITH CAUTION!')
+    parser.add_option('-j', '--workers', default=4, type='int',
+                      help='number of tarballs to upload at once [default: %default]')
     opts, args = parser.parse_args(bargs)
     if opts.list_uploads:
         p = pulp_login(bopts)
@@ -1056,57 +1203,53 @@ def do_upload(bopts, bargs, parser):
         log.warning('Please supply repos to upload to in the future')
     if len(args) < 1:
         parser.error('You must provide an image to upload')
-    if not os.path.exists(args[0]):
-        parser.error('Could not find %s' % args[0])
-    log.info('uploading %s' % args[0])
-    log.info('Ensuring image conforms to Pulp requirements')
-    # TODO: this gets read again during the upload
-    manifest = dockpulp.imgutils.get_manifest(args[0])
-    metadata = dockpulp.imgutils.get_metadata(args[0])
-    newimgs = list(dockpulp.imgutils.get_metadata_pulp(metadata).keys())
-    log.info('Layers in this tarball:')
-    for img in newimgs:
-        log.info('  %s' % img)
-    vers = dockpulp.imgutils.get_versions(manifest)
-    good = True
-    for id, version in vers.items():
-        minor = int(version[2:version.index('.', 2)])
-        if version.startswith('0') and minor < 10:
-            log.error('Ancient docker version detected in layer')
-            log.error('  %s (%s)' % (id, version))
-            good = False
-    if not good:
-        log.error('Layer(s) in the image were created with an unsupported')
-        log.error('version of docker, you cannot upload this image. Dev')
-        log.error('needs to rebuild it with only supported versions at every')
-        log.error('layer.')
-        sys.exit(1)
-    r_chk = dockpulp.imgutils.check_repo(args[0])
-    if r_chk == 1:
-        log.error('Image is missing a "repositories" file in the root of the')
-        log.error('tarball filesystem. Engineering needs to rebuild it with')
-        log.error('exactly 1 repository defined.')
-        sys.exit(2)
-    elif r_chk == 2:
-        log.error('Pulp demands exactly one repository defined in the')
-        log.error('"repositories" file, Engineering needs to rebuild it with')
-        log.error('exactly 1 repository defined.')
-        sys.exit(3)
-    elif r_chk == 3:
-        log.error('The "repositories" file references images that are not a')
-        log.error('part of the tarball itself. Uploading this will yield')
-        log.error('inconsistent repository metadata, so it is forbidden.')
-        log.error('Make sure Engineering saved it with "docker save id:TAG"')
-        sys.exit(4)
-    if args[0].endswith('.xz'):
-        log.error('Pulp can only extract gzipped tarballs, not xz.')
-        log.error('Decompress it with unxz and then recompress with gzip')
-        log.error('and try again.')
-        sys.exit(5)
+    if args[0] == '-':
+        # image is streamed on stdin, it gets checked while it is uploaded
+        log.info('uploading image from stdin')
+        p = pulp_login(bopts)
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        drepo = args[1] if len(args) > 1 else dockpulp.HIDDEN
+        try:
+            p.upload_stream(stdin, drepo=drepo, validate=_validate_stream)
+        except ImageCheckError as e:
+            sys.exit(e.status)
+        log.info('Upload complete')
+        return
+    images = args[:-1] if len(args) > 2 else args[:1]
+    for image in images:
+        if not os.path.exists(image):
+            parser.error('Could not find %s' % image)
+        if (dockpulp.imgutils.get_compression(image) == 'xz' and
+                dockpulp.imgutils.lzma is None):
+            log.error('Pulp can only extract gzipped tarballs, and xz images can')
+            log.error('only be converted on the fly with the lzma module installed.')
+            log.error('Decompress it with unxz and then recompress with gzip')
+            log.error('and try again.')
+            sys.exit(5)
+    # the images are checked against Pulp requirements while they are sent
+    log.info('Ensuring image conforms to Pulp requirements during the upload')
     p = pulp_login(bopts)
-    if len(args) > 1:
-        p.upload(args[0], drepo=args[1])
+    if len(images) > 1:
+        results = p.upload_many(images, drepo=args[-1], workers=opts.workers,
+                                validate=_validate_image)
+        log.info('Upload results:')
+        failed = False
+        for image in images:
+            result = results[image]
+            if result['error']:
+                failed = True
+                log.error('  %s: failed: %s' % (image, result['error']))
+            else:
+                log.info('  %s: %s (%s new layers sent)' %
+                         (image, result['image_id'], len(result['uploaded'])))
+        if failed:
+            sys.exit(1)
     else:
-        p.upload(args[0])
+        log.info('uploading %s' % args[0])
+        drepo = args[1] if len(args) > 1 else dockpulp.HIDDEN
+        try:
+            p.upload(args[0], drepo=drepo, validate=_validate_image)
+        except ImageCheckError as e:
+            sys.exit(e.status)
 
     log.info('Upload complete')
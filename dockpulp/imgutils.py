@@ -13,9 +13,22 @@
 # You should have received a copy of the GNU General Public License
 # along with dockpulp.  If not, see <http://www.gnu.org/licenses/>.
 
+import bz2
 import contextlib
+import hashlib
 import os
 import tarfile
+import threading
+import zlib
+
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+
+try:
+    import lzma
+except ImportError:
+    # Python 2 needs backports.lzma, without it xz images cannot be transcoded
+    lzma = None
 
 try:
     # Python 2.6 and earlier
@@ -30,6 +43,12 @@ except ImportError:
 
 # see https://github.com/pulp/pulp_docker/blob/master/common/pulp_docker/common/tarutils.py
 
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bzip2'),
+)
+
 
 def get_manifest(tarfile_path):
     """Extract and return manifest in tarball.
@@ -118,7 +137,6 @@ def check_repo(tarfile_path):
     2 - more than 1 repository is defined in the file, pulp requires 1
     3 - repositories file references image IDs not in the tarball itself
     """
-    found = False
     repo_data = None
     seen_ids = []
     with contextlib.closing(tarfile.open(tarfile_path)) as archive:
@@ -126,20 +144,354 @@ def check_repo(tarfile_path):
             # member.path can be: "repositories" or "./repositories"
             if os.path.basename(member.path) == "repositories":
                 repo_data = json.load(archive.extractfile(member))
-                found = True
                 if len(repo_data) != 1:
                     return 2
             else:
                 seen_ids.append(os.path.basename(member.path))
-    if found is False:
+    return _check_repo_data(repo_data, seen_ids)
+
+
+def _check_repo_data(repo_data, seen_ids):
+    """Return the check_repo code for parsed "repositories" data."""
+    if repo_data is None:
         return 1
-    val = repo_data.popitem()[1]  # don't care about repo name at all
+    if len(repo_data) != 1:
+        return 2
+    val = list(repo_data.values())[0]  # don't care about repo name at all
     for ver, iid in val.items():
         if iid not in seen_ids:
             return 3
     return 0
 
 
+def filter_layers(tarfile_path, fileobj, skip_ids):
+    """Write a copy of the tarball to fileobj without some layer payloads.
+
+    The layer.tar of every image ID in skip_ids is dropped. All metadata
+    files are kept so Pulp can still work out the ancestry of the image.
+    Returns the number of layers that were left out.
+    """
+    skipped = 0
+    with contextlib.closing(tarfile.open(tarfile_path)) as archive:
+        with contextlib.closing(tarfile.open(fileobj=fileobj, mode='w|')) as reduced:
+            for member in archive:
+                if (os.path.basename(member.path) == 'layer.tar' and
+                        os.path.basename(os.path.dirname(member.path)) in skip_ids):
+                    skipped += 1
+                    continue
+                if member.isfile():
+                    reduced.addfile(member, archive.extractfile(member))
+                else:
+                    reduced.addfile(member)
+    return skipped
+
+
+def _hash_stream(fobj, blocksize, size=None):
+    """Hash a file object until EOF or size bytes, return the digest and size."""
+    digest = hashlib.sha256()
+    read = 0
+    while size is None or read < size:
+        want = blocksize if size is None else min(blocksize, size - read)
+        block = fobj.read(want)
+        if not block:
+            break
+        digest.update(block)
+        read += len(block)
+    return 'sha256:' + digest.hexdigest(), read
+
+
+def _hash_member(tarfile_path, offset, size, blocksize):
+    """Hash size bytes at offset of a file, through a file object of its own."""
+    with open(tarfile_path, 'rb') as f:
+        f.seek(offset)
+        return _hash_stream(f, blocksize, size)
+
+
+def get_layer_digests(tarfile_path, workers=4, blocksize=1024 * 1024):
+    """Return the sha256 digest and size of every layer in a tarball.
+
+    In an uncompressed tarball every layer.tar is hashed by one of the
+    workers, each reading its layer from its own file object. A compressed
+    tarball can only be read in order, so its layers are hashed one after
+    the other while it is read. Returns a dict of image ID to a dict with
+    the "digest", the uncompressed "size" and "valid". For archives saved by
+    docker 1.10 and later, valid tells whether the digest matches the
+    diff_id recorded in the image config; it is None otherwise.
+    """
+    seekable = get_compression(tarfile_path) is None
+    layers = []
+    configs = {}
+    with contextlib.closing(tarfile.open(tarfile_path, 'r:' if seekable else 'r|*')) as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            path = os.path.normpath(member.path)
+            if os.path.basename(path) == 'layer.tar':
+                if seekable:
+                    layers.append((path, (member.offset_data, member.size)))
+                else:
+                    layers.append((path, _hash_stream(archive.extractfile(member), blocksize)))
+            elif path.endswith('.json') and os.path.dirname(path) == '':
+                # manifest.json and the image configs, both are small
+                configs[path] = json.loads(archive.extractfile(member).read().decode('utf-8'))
+    if seekable and layers:
+        pool = ThreadPool(min(workers, len(layers)))
+        try:
+            results = [(path, pool.apply_async(_hash_member,
+                                               (tarfile_path, offset, size, blocksize)))
+                       for path, (offset, size) in layers]
+            layers = [(path, result.get()) for path, result in results]
+        finally:
+            pool.close()
+            pool.join()
+    diff_ids = {}
+    for entry in configs.get('manifest.json', []):
+        config = configs.get(entry.get('Config'), {})
+        for path, diff_id in zip(entry.get('Layers', []),
+                                 config.get('rootfs', {}).get('diff_ids', [])):
+            diff_ids[os.path.normpath(path)] = diff_id
+    digests = {}
+    for path, (digest, size) in layers:
+        expected = diff_ids.get(path)
+        digests[os.path.basename(os.path.dirname(path))] = {
+            'digest': digest,
+            'size': size,
+            'valid': None if expected is None else expected == digest,
+        }
+    return digests
+
+
+def get_compression(tarfile_path):
+    """Return the compression of a tarball: "gzip", "xz", "bzip2" or None."""
+    with open(tarfile_path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+class GzipTranscoder(object):
+    """Read a xz or bzip2 compressed file as a gzip compressed stream.
+
+    Pulp can only extract gzipped tarballs. Decompression and compression
+    each run on their own thread and hand data over through bounded queues,
+    so memory use does not depend on the size of the image. Call close()
+    once done reading, so the threads stop even if the stream was not read
+    to the end.
+    """
+
+    def __init__(self, fobj, compression, blocksize=1024 * 1024, maxsize=4):
+        if compression == 'xz':
+            if lzma is None:
+                raise ValueError('xz support requires the lzma module')
+            self.decompressor_class = lzma.LZMADecompressor
+        elif compression == 'bzip2':
+            self.decompressor_class = bz2.BZ2Decompressor
+        else:
+            raise ValueError('cannot transcode %s to gzip' % compression)
+        self.fobj = fobj
+        self.blocksize = blocksize
+        self.error = None
+        self._closed = threading.Event()
+        self._raw = queue.Queue(maxsize)
+        self._pipe = _QueueReader(maxsize)
+        self._threads = [threading.Thread(target=self._decompress),
+                         threading.Thread(target=self._compress)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, chunks, data):
+        """Put data on a queue, return False instead if closed meanwhile."""
+        while not self._closed.is_set():
+            try:
+                chunks.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, chunks):
+        """Get data from a queue, return None instead if closed meanwhile."""
+        while not self._closed.is_set():
+            try:
+                return chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _decompress(self):
+        decompressor = self.decompressor_class()
+        # Python 3 decompressors can stop after max_length bytes of output,
+        # so a small block of a highly compressed image stays a small block
+        bounded = hasattr(decompressor, 'needs_input')
+        pending = False  # has the current decompressor been fed?
+        try:
+            while not self._closed.is_set():
+                data = self.fobj.read(self.blocksize)
+                if not data:
+                    break
+                while data is not None:
+                    pending = True
+                    if bounded:
+                        out = decompressor.decompress(data, self.blocksize)
+                    else:
+                        out = decompressor.decompress(data)
+                    if out and not self._put(self._raw, out):
+                        return
+                    if getattr(decompressor, 'eof', False):
+                        # parallel compressors write several concatenated streams
+                        data = decompressor.unused_data or None
+                        decompressor = self.decompressor_class()
+                        pending = False
+                    elif bounded and not decompressor.needs_input:
+                        # output of the data already given is left
+                        data = b''
+                    else:
+                        data = None
+            # Python 2 decompressors cannot tell whether the stream was complete
+            if pending and not getattr(decompressor, 'eof', True):
+                raise EOFError('compressed image ended before the end of the stream')
+        except Exception as e:
+            self.error = e
+        self._put(self._raw, None)
+
+    def _compress(self):
+        # wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        while True:
+            data = self._get(self._raw)
+            if data is None:
+                break
+            data = compressor.compress(data)
+            if data and not self._put(self._pipe.chunks, data):
+                return
+        if self._put(self._pipe.chunks, compressor.flush()):
+            self._put(self._pipe.chunks, None)
+
+    def read(self, size=-1):
+        data = self._pipe.read(size)
+        if not data and self.error is not None:
+            raise self.error
+        return data
+
+    def close(self):
+        """Stop the threads, whether or not the stream was read to the end.
+
+        The file object is only read by the threads, it can be closed once
+        this returns. Nothing can be read after closing.
+        """
+        self._closed.set()
+        for thread in self._threads:
+            thread.join()
+
+
+class _QueueReader(object):
+    """Read-only file object fed with chunks of bytes through a queue."""
+
+    def __init__(self, maxsize):
+        self.chunks = queue.Queue(maxsize)
+        self.chunk = b''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and not self.eof:
+            if self.pos >= len(self.chunk):
+                chunk = self.chunks.get()
+                if chunk is None:
+                    self.eof = True
+                else:
+                    self.chunk, self.pos = chunk, 0
+                continue
+            end = len(self.chunk)
+            if size > 0:
+                end = min(end, self.pos + size)
+                size -= end - self.pos
+            parts.append(self.chunk[self.pos:end])
+            self.pos = end
+        return b''.join(parts)
+
+
+class StreamInspector(object):
+    """Collect the metadata of a "docker save" stream while it is read.
+
+    Wraps a file object that can only be read once, such as stdin. Every
+    read is handed back to the caller and parsed as a tarball by a
+    background thread at the same time, so the image is only read once.
+    Call close() after the last read; the metadata is available after that.
+    """
+
+    def __init__(self, fobj, maxsize=8):
+        self.fobj = fobj
+        self.size = 0
+        self.error = None
+        self.layers = {}  # basename -> parsed "json" file of each layer
+        self.configs = {}  # basename -> parsed json files at the top level
+        self.initial_manifest = None
+        self.repo_data = None
+        self.seen_ids = []
+        self._pipe = _QueueReader(maxsize)
+        self._thread = threading.Thread(target=self._parse)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _parse(self):
+        try:
+            with contextlib.closing(tarfile.open(fileobj=self._pipe, mode='r|*')) as archive:
+                for member in archive:
+                    name = os.path.basename(member.path)
+                    if name == 'repositories':
+                        self.repo_data = json.loads(archive.extractfile(member).read())
+                        continue
+                    self.seen_ids.append(name)
+                    if name == 'manifest.json':
+                        self.initial_manifest = json.loads(archive.extractfile(member).read())
+                    elif name == 'json':
+                        layer = os.path.basename(os.path.dirname(member.path))
+                        self.layers[layer] = json.loads(archive.extractfile(member).read())
+                    elif name.endswith('.json') and member.isfile():
+                        self.configs[name] = json.loads(archive.extractfile(member).read())
+        except Exception as e:
+            self.error = e
+        # keep consuming so the reader never blocks on a full queue
+        while self._pipe.read(65536):
+            pass
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        if data:
+            self.size += len(data)
+            self._pipe.chunks.put(data)
+        return data
+
+    def close(self):
+        """Wait for the parser to finish, raise if the stream was not a tarball."""
+        self._pipe.chunks.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def get_manifest(self):
+        """Return the manifest of the stream, like get_manifest does for a file."""
+        if self.initial_manifest:
+            configjson = self.initial_manifest[0]['Config']
+            if configjson in self.configs:
+                return [self.configs[configjson]]
+            return []
+        return list(self.layers.values())
+
+    def get_metadata(self):
+        """Return the layer metadata, like get_metadata does for a file."""
+        return list(self.layers.values())
+
+    def check_repo(self):
+        """Check the "repositories" file, like check_repo does for a file."""
+        return _check_repo_data(self.repo_data, self.seen_ids)
+
+
 def _get_hops(iid, md, hops=0):
     """Return how many parents (layers) an image has."""
     par = md[iid].get('parent', None)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 
-from dockpulp import cli
+from dockpulp import cli, errors
 import pytest
 import os
 import json
@@ -49,6 +49,18 @@ class testPulp(object):
     def getAncestors(self, arg):
         return arg
 
+    def getAncestry(self, iids, parents=None):
+        return {}
+
+    def getGarbagePlan(self, workers=None, manifests=False, paginate=True):
+        return {}
+
+    def collectGarbage(self, plan, manifests=False, future=False):
+        return
+
+    def getImageParents(self, repo):
+        return {}
+
     def getPrefix(self):
         return
 
@@ -58,12 +70,18 @@ class testPulp(object):
     def copy(self, arg1, arg2):
         return
 
+    def copyMany(self, arg1, arg2, source=None):
+        return
+
     def listRepos(self, repos=None, content=None, history=None, labels=None, paginate=None):
         return
 
     def updateRepo(self, arg1, arg2):
         return
 
+    def updateTags(self, arg1, arg2):
+        return
+
     def deleteRepo(self, arg1, arg2):
         return
 
@@ -81,6 +99,13 @@ class testPulp(object):
                  paginate=None):
         return
 
+    def syncRepos(self, env=None, repos=(), config_file=None, feed=None, workers=None,
+                  **kwargs):
+        return {}
+
+    def upload_many(self, images, drepo=None, workers=None, validate=None):
+        return {}
+
 
 # tests
 class TestCLI(object):
@@ -193,7 +218,7 @@ class TestCLI(object):
                 prefix_with = ''
             else:
                 prefix_with = 'redhat-'
-            tags = {'tag': '1:1'}
+            tags = {'1': '1'}
             flexmock(testPulp)
             if not noprefix:
                 (testPulp
@@ -211,23 +236,23 @@ class TestCLI(object):
                 .with_args(repoid, None, desc=None, title=None, protected=False,
                            productline=productid, distribution=None, prefix_with=prefix_with)
                 .and_return(None))
-            if img:
+            content = list(images) + list(manifests)
+            if content:
                 (testPulp
-                    .should_receive('copy')
+                    .should_receive('copyMany')
                     .once()
-                    .with_args(repoid, '1')
+                    .with_args(repoid, content)
                     .and_return(None))
+            else:
+                testPulp.should_receive('copyMany').never()
+            if img:
                 (testPulp
-                    .should_receive('updateRepo')
+                    .should_receive('updateTags')
                     .once()
                     .with_args(repoid, tags)
                     .and_return(None))
-            if manifest:
-                (testPulp
-                    .should_receive('copy')
-                    .once()
-                    .with_args(repoid, '2')
-                    .and_return(None))
+            else:
+                testPulp.should_receive('updateTags').never()
             assert cli.do_clone(bopts, bargs) is None
 
     @pytest.mark.parametrize('lib', [True, False])
@@ -317,6 +342,53 @@ class TestCLI(object):
         else:
             assert cli.do_empty(bopts, bargs) is None
 
+    @pytest.mark.parametrize('failed', [False, True])
+    @patch('dockpulp.Pulp')
+    def test_do_copy(self, mocked_pulp, caplog, failed):
+        bopts = testbOpts()
+        p = testPulp()
+        mocked_pulp.side_effect = [p]
+        copy = (flexmock(testPulp)
+                .should_receive('copyMany')
+                .with_args('test-repo', ['img1', 'img2'], None)
+                .once())
+        if failed:
+            copy.and_raise(errors.DockPulpError('Pulp tasks failed'))
+            with pytest.raises(errors.DockPulpError):
+                cli.do_copy(bopts, ['test-repo', 'img1', 'img2'])
+            assert 'copying successful' not in caplog.text
+        else:
+            with caplog.at_level(logging.INFO, logger='dockpulp'):
+                cli.do_copy(bopts, ['test-repo', 'img1', 'img2'])
+            assert 'copying successful' in caplog.text
+
+    @pytest.mark.parametrize('bargs,removed', [
+        ('--plan', False),
+        ('--remove', True),
+        ('', None),
+    ])
+    @patch('dockpulp.Pulp')
+    def test_do_gc(self, mocked_pulp, bargs, removed):
+        bargs = bargs.split()
+        bopts = testbOpts()
+        p = testPulp()
+        mocked_pulp.side_effect = [p]
+        if removed is None:
+            with pytest.raises(SystemExit):
+                cli.do_gc(bopts, bargs)
+            return
+        plan = {'test-repo': ['sha256:x', 'testimage']}
+        (flexmock(testPulp)
+            .should_receive('getGarbagePlan')
+            .with_args(workers=4, manifests=False, paginate=True)
+            .and_return(plan)
+            .once())
+        (flexmock(testPulp)
+            .should_receive('collectGarbage')
+            .with_args(plan, manifests=False)
+            .times(1 if removed else 0))
+        assert cli.do_gc(bopts, bargs) is None
+
     @pytest.mark.parametrize('silent', [True, False])
     @patch('dockpulp.Pulp')
     def test_do_list(self, mocked_pulp, caplog, silent):
@@ -383,6 +455,29 @@ class TestCLI(object):
                     .and_return(repos))
                 assert cli.do_remove(bopts, bargs) is None
 
+    @patch('dockpulp.Pulp')
+    def test_do_remove_unneeded(self, mocked_pulp):
+        bopts = testbOpts()
+        p = testPulp()
+        mocked_pulp.side_effect = [p]
+        repos = [{'id': 'test-repo',
+                  'images': {'tagged': ['latest'], 'parent': [], 'base': [], 'stray': []}}]
+        flexmock(testPulp).should_receive('listRepos').and_return(repos)
+        (flexmock(testPulp)
+            .should_receive('getImageParents')
+            .with_args('test-repo')
+            .and_return({'tagged': 'parent', 'parent': 'base', 'stray': None})
+            .once())
+        (flexmock(testPulp)
+            .should_receive('getAncestry')
+            .with_args(['tagged'], parents={'tagged': 'parent', 'parent': 'base',
+                                            'stray': None})
+            .and_return({'tagged': ['parent', 'base']})
+            .once())
+        flexmock(testPulp).should_receive('remove').with_args('test-repo', 'old').once()
+        flexmock(testPulp).should_receive('remove').with_args('test-repo', ['stray']).once()
+        assert cli.do_remove(bopts, ['test-repo', 'old']) is None
+
     @pytest.mark.parametrize('silent', [True, False])
     @pytest.mark.parametrize('num_tasks', (1, 2, 30))
     @patch('dockpulp.Pulp')
@@ -467,6 +562,40 @@ class TestCLI(object):
                 .and_return(response))
             assert cli.do_sync(bopts, bargs) is None
 
+    @patch('dockpulp.Pulp')
+    def test_do_sync_many(self, mocked_pulp, tmpdir):
+        bopts = testbOpts()
+        p = testPulp()
+        mocked_pulp.side_effect = [p]
+        repo_file = tmpdir.join('repos')
+        repo_file.write('# repos to sync\nrepo-b\n\nrepo-c\n')
+        result = ([], [], [])
+        (flexmock(testPulp)
+            .should_receive('syncRepos')
+            .with_args('qa', ['repo-a', 'repo-b', 'repo-c'], bopts.config_file, workers=2,
+                       feed=None, basic_auth_username=None, basic_auth_password=None,
+                       ssl_validation=False, paginate=True)
+            .and_return({'repo-a': result, 'repo-b': result, 'repo-c': result})
+            .once())
+        bargs = ['--from', 'qa', 'repo-a', '--file', str(repo_file), '-j', '2']
+        assert cli.do_sync(bopts, bargs) is None
+
+    @patch('dockpulp.Pulp')
+    def test_do_upload_many(self, mocked_pulp, tmpdir):
+        bopts = testbOpts()
+        p = testPulp()
+        mocked_pulp.side_effect = [p]
+        images = [str(tmpdir.join(name)) for name in ('a.tar', 'b.tar')]
+        for image in images:
+            open(image, 'w').close()
+        result = {'error': None, 'image_id': 'id', 'uploaded': []}
+        (flexmock(testPulp)
+            .should_receive('upload_many')
+            .with_args(images, drepo='test-repo', workers=2, validate=object)
+            .and_return(dict((image, result) for image in images))
+            .once())
+        assert cli.do_upload(bopts, images + ['test-repo', '-j', '2']) is None
+
     @pytest.mark.parametrize('bargs',
                              ['test-repo -r /contentdist --download True --auto-publish false',
                               None])
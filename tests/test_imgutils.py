@@ -4,9 +4,13 @@
 
 from dockpulp import imgutils
 import pytest
+import bz2
+import hashlib
+import json
 import tarfile
 import os
 from io import BytesIO
+from flexmock import flexmock
 
 
 class TarWriter(object):
@@ -58,3 +62,159 @@ class TestImgutils(object):
             assert imgutils.check_repo(filename) == 3
         else:
             assert imgutils.check_repo(filename) == 0
+
+    @pytest.mark.parametrize('mode', ['w|', 'w|gz'])
+    def test_stream_inspector(self, tmpdir, mode):
+        filename = str(tmpdir.join("archive.tar"))
+        with open(filename, 'wb') as f:
+            with tarfile.open(fileobj=f, mode=mode) as t:
+                for layer in ('base', 'top'):
+                    ti = tarfile.TarInfo(layer)
+                    ti.type = tarfile.DIRTYPE
+                    t.addfile(ti)
+                for name, content in (('base/json', b'{"id": "base"}'),
+                                      ('base/layer.tar', b'x' * 100000),
+                                      ('top/json', b'{"id": "top", "parent": "base"}'),
+                                      ('top/layer.tar', b'y' * 100000),
+                                      ('repositories', b'{"foo": {"latest": "top"}}')):
+                    ti = tarfile.TarInfo(name)
+                    ti.size = len(content)
+                    t.addfile(ti, fileobj=BytesIO(content))
+
+        with open(filename, 'rb') as f:
+            inspector = imgutils.StreamInspector(f)
+            data = b''
+            while True:
+                chunk = inspector.read(4096)
+                if not chunk:
+                    break
+                data += chunk
+            inspector.close()
+
+        with open(filename, 'rb') as f:
+            assert data == f.read()
+        assert inspector.size == len(data)
+        assert inspector.get_metadata() == imgutils.get_metadata(filename)
+        assert inspector.get_manifest() == imgutils.get_manifest(filename)
+        assert inspector.check_repo() == imgutils.check_repo(filename) == 0
+
+    def test_stream_inspector_not_a_tarball(self):
+        inspector = imgutils.StreamInspector(BytesIO(b'not a tarball' * 1000))
+        while inspector.read(100):
+            pass
+        with pytest.raises(tarfile.TarError):
+            inspector.close()
+
+    @pytest.mark.parametrize('mode', ['w|', 'w|gz'])
+    @pytest.mark.parametrize('corrupt', [False, True])
+    def test_get_layer_digests(self, tmpdir, mode, corrupt):
+        filename = str(tmpdir.join("archive.tar"))
+        layers = {'base': os.urandom(300000), 'top': os.urandom(1000)}
+        diff_ids = ['sha256:' + hashlib.sha256(layers[name]).hexdigest()
+                    for name in ('base', 'top')]
+        if corrupt:
+            diff_ids[1] = 'sha256:' + hashlib.sha256(b'other').hexdigest()
+        config = json.dumps({'rootfs': {'type': 'layers', 'diff_ids': diff_ids}})
+        manifest = json.dumps([{'Config': 'config.json',
+                                'Layers': ['base/layer.tar', 'top/layer.tar']}])
+        with open(filename, 'wb') as f:
+            with tarfile.open(fileobj=f, mode=mode) as t:
+                for name, content in (('base/layer.tar', layers['base']),
+                                      ('top/layer.tar', layers['top']),
+                                      ('config.json', config.encode('utf-8')),
+                                      ('manifest.json', manifest.encode('utf-8'))):
+                    ti = tarfile.TarInfo(name)
+                    ti.size = len(content)
+                    t.addfile(ti, fileobj=BytesIO(content))
+
+        # layers of an uncompressed tarball are read in place, one file object each
+        flexmock(imgutils).should_call('_hash_member').times(2 if mode == 'w|' else 0)
+        digests = imgutils.get_layer_digests(filename, workers=2, blocksize=4096)
+        assert digests['base'] == {'digest': 'sha256:' + hashlib.sha256(layers['base']).hexdigest(),
+                                   'size': 300000, 'valid': True}
+        assert digests['top']['size'] == 1000
+        assert digests['top']['valid'] is not corrupt
+
+    def test_get_layer_digests_legacy(self, tmpdir):
+        filename = str(tmpdir.join("archive.tar"))
+        with TarWriter(filename, directory='base') as t:
+            t.write_file('json', b'{"id": "base"}')
+            t.write_file('layer.tar', b'x' * 5000)
+        digests = imgutils.get_layer_digests(filename)
+        assert digests == {'base': {'digest': 'sha256:' + hashlib.sha256(b'x' * 5000).hexdigest(),
+                                    'size': 5000, 'valid': None}}
+
+    @pytest.mark.parametrize('compression, mode', [('xz', 'w:xz'), ('bzip2', 'w:bz2')])
+    def test_gzip_transcoder(self, tmpdir, compression, mode):
+        filename = str(tmpdir.join("archive.tar"))
+        content = os.urandom(300000)
+        with tarfile.open(filename, mode=mode) as t:
+            ti = tarfile.TarInfo('layer.tar')
+            ti.size = len(content)
+            t.addfile(ti, fileobj=BytesIO(content))
+
+        assert imgutils.get_compression(filename) == compression
+        with open(filename, 'rb') as f:
+            transcoder = imgutils.GzipTranscoder(f, compression, blocksize=4096)
+            data = b''
+            while True:
+                chunk = transcoder.read(10000)
+                if not chunk:
+                    break
+                data += chunk
+
+        assert data.startswith(b'\x1f\x8b')
+        with tarfile.open(fileobj=BytesIO(data), mode='r:gz') as t:
+            assert t.extractfile('layer.tar').read() == content
+
+    @pytest.mark.parametrize('compression, mode', [('xz', 'w:xz'), ('bzip2', 'w:bz2')])
+    def test_gzip_transcoder_bounded(self, tmpdir, compression, mode):
+        if not hasattr(bz2.BZ2Decompressor(), 'needs_input'):
+            pytest.skip('decompressors cannot bound their output')
+        filename = str(tmpdir.join("archive.tar"))
+        content = b'\0' * 3000000
+        with tarfile.open(filename, mode=mode) as t:
+            ti = tarfile.TarInfo('layer.tar')
+            ti.size = len(content)
+            t.addfile(ti, fileobj=BytesIO(content))
+        sizes = []
+
+        class Recording(imgutils.GzipTranscoder):
+            def _put(self, chunks, data):
+                if chunks is self._raw and data:
+                    sizes.append(len(data))
+                return imgutils.GzipTranscoder._put(self, chunks, data)
+
+        with open(filename, 'rb') as f:
+            transcoder = Recording(f, compression, blocksize=4096)
+            data = b''
+            while True:
+                chunk = transcoder.read(10000)
+                if not chunk:
+                    break
+                data += chunk
+            transcoder.close()
+
+        # a few kilobytes of zeros decompress to megabytes, handed over block by block
+        assert max(sizes) <= 4096
+        with tarfile.open(fileobj=BytesIO(data), mode='r:gz') as t:
+            assert t.extractfile('layer.tar').read() == content
+
+    def test_gzip_transcoder_close(self, tmpdir):
+        filename = str(tmpdir.join("archive.tar"))
+        with tarfile.open(filename, mode='w:bz2') as t:
+            content = os.urandom(300000)
+            ti = tarfile.TarInfo('layer.tar')
+            ti.size = len(content)
+            t.addfile(ti, fileobj=BytesIO(content))
+        with open(filename, 'rb') as f:
+            transcoder = imgutils.GzipTranscoder(f, 'bzip2', blocksize=4096, maxsize=1)
+            assert transcoder.read(100)
+            transcoder.close()
+            assert not any(thread.is_alive() for thread in transcoder._threads)
+
+    def test_gzip_transcoder_corrupt(self):
+        transcoder = imgutils.GzipTranscoder(BytesIO(b'BZh91AY&SYgarbage'), 'bzip2')
+        with pytest.raises(Exception):
+            while transcoder.read(100):
+                pass
@@ -3,12 +3,18 @@
 
 from copy import deepcopy
 from datetime import datetime
-from dockpulp import Pulp, Crane, RequestsHttpCaller, errors, log
+import dockpulp
+from dockpulp import (Pulp, Crane, ChunkReader, ChunkSizer, RequestsHttpCaller, TaskFuture,
+                      TaskWatcher, errors, log)
 import pytest
 import hashlib
 import json
+import os
 import requests
 import tarfile
+import threading
+import time
+from io import BytesIO
 import logging
 import subprocess
 from tempfile import NamedTemporaryFile
@@ -232,6 +238,25 @@ class testHash(object):
         return self.output
 
 
+def write_image(path, layers):
+    """Write a "docker save" style tarball, layers are (id, parent) tuples."""
+    with tarfile.open(path, mode='w') as tar:
+        for iid, parent in layers:
+            info = tarfile.TarInfo(iid)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            for name, content in (('json', json.dumps({'id': iid, 'parent': parent})),
+                                  ('layer.tar', 'layer data of %s' % iid)):
+                content = content.encode('utf-8')
+                info = tarfile.TarInfo('%s/%s' % (iid, name))
+                info.size = len(content)
+                tar.addfile(info, BytesIO(content))
+        content = json.dumps({'foo/bar': {'latest': layers[-1][0]}}).encode('utf-8')
+        info = tarfile.TarInfo('repositories')
+        info.size = len(content)
+        tar.addfile(info, BytesIO(content))
+
+
 HTTP_RETRIES_STATUS_FORCELIST = (500, 502, 503, 504)
 fake_retry = Retry(total=1,
                    backoff_factor=1,
@@ -770,6 +795,66 @@ class TestPulp(object):
             else:
                 assert response['notes']['include_in_download_service'] == "False"
 
+    @pytest.mark.parametrize('fail', [False, True])
+    def test_syncRepos(self, pulp, fail):
+        flexmock(Pulp)
+        (Pulp
+            .should_receive('_getRepo')
+            .with_args('qa', '/etc/dockpulp.conf')
+            .replace_with(lambda env, config_file: setattr(pulp, 'syncenv', 'https://qa'))
+            .once())
+        for repo in ('a', 'b'):
+            (Pulp
+                .should_receive('syncRepo')
+                .with_args('qa', repo, '/etc/dockpulp.conf', feed='https://qa', paginate=False)
+                .and_return(([repo], [], []))
+                .once())
+        if fail:
+            (Pulp
+                .should_receive('syncRepo')
+                .with_args('qa', 'c', '/etc/dockpulp.conf', feed='https://qa', paginate=False)
+                .and_raise(errors.DockPulpTaskError('sync failed'))
+                .once())
+            with pytest.raises(errors.DockPulpError) as exc:
+                pulp.syncRepos('qa', ['a', 'b', 'c'], '/etc/dockpulp.conf', paginate=False)
+            assert 'Failed to sync: c' in str(exc.value)
+            return
+        assert pulp.syncRepos('qa', ['a', 'b'], '/etc/dockpulp.conf', workers=2,
+                              paginate=False) == {'a': (['a'], [], []), 'b': (['b'], [], [])}
+
+    def test_createRepos(self, pulp):
+        pulp.dist_switchover = {'2.8': 'docker_rsync_distributor,docker_rsync_new'}
+        created = []
+        lock = threading.Lock()
+
+        def fake_post(api, data):
+            data = json.loads(data)
+            if api == '/pulp/api/v2/repositories/search/':
+                assert data['criteria']['fields'] == ['id']
+                assert sorted(data['criteria']['filters']['id']['$in']) == [
+                    'origin-redhat-a', 'origin-redhat-b', 'origin-redhat-old',
+                    'redhat-a', 'redhat-b', 'redhat-old']
+                return [{'id': 'redhat-old'}, {'id': 'origin-redhat-b'}]
+            assert api == '/pulp/api/v2/repositories/'
+            with lock:
+                created.append(data)
+
+        flexmock(Pulp)
+        Pulp.should_receive('_post').replace_with(fake_post)
+        Pulp.should_receive('getPulpVersion').and_return('2.9').once()
+        Pulp.should_receive('createOriginRepo').never()
+        result = pulp.createRepos([{'repo_id': 'a', 'url': '/content/a'},
+                                   {'repo_id': 'redhat-b', 'url': '/content/b'},
+                                   {'repo_id': 'old', 'url': '/content/old'}])
+        assert [r['id'] for r in result] == ['redhat-a', 'redhat-b']
+        assert sorted(r['id'] for r in created) == ['origin-redhat-a', 'redhat-a', 'redhat-b']
+        registry_ids = sorted(d['distributor_config']['repo-registry-id']
+                              for r in created for d in r['distributors']
+                              if d['distributor_type_id'] == 'docker_distributor_web')
+        assert registry_ids == ['a', 'b']
+        assert 'docker_rsync_new' in [d['distributor_type_id'] for d in result[0]['distributors']]
+        assert pulp._pulp_version is None
+
     def test_disassociate(self, pulp):
         repo = 'testrepo'
         dist_id = 'foo'
@@ -903,6 +988,472 @@ class TestPulp(object):
             .and_return(None))
         pulp.remove(repo, img)
 
+    def test_copyMany(self, pulp, monkeypatch):
+        monkeypatch.setattr(dockpulp, 'BATCH_SIZE', 2)
+        sources = {'img1': 'redhat-a', 'img2': 'redhat-a', 'img3': 'redhat-a',
+                   'sha256:x': 'redhat-b', 'sha256:y': 'redhat-b'}
+        flexmock(Pulp)
+        (Pulp
+            .should_receive('_find_content_sources')
+            .replace_with(lambda content_ids, content_filter, types:
+                          dict((c, sources[c]) for c in content_ids))
+            .twice())
+        sent = []
+
+        def fake_post(api, data):
+            assert api == '/pulp/api/v2/repositories/redhat-dest/actions/associate/'
+            sent.append(json.loads(data))
+            return 'task%s' % len(sent)
+
+        Pulp.should_receive('_post').replace_with(fake_post)
+        Pulp.should_receive('watch_tasks').with_args(['task1', 'task2', 'task3']).once()
+        pulp.copyMany('redhat-dest', sorted(sources))
+        assert [(d['source_repo_id'], d['criteria']['filters']['unit']) for d in sent] == [
+            ('redhat-a', {'image_id': {'$in': ['img1', 'img2']}}),
+            ('redhat-a', {'image_id': {'$in': ['img3']}}),
+            ('redhat-b', {'$or': [{'digest': {'$in': ['sha256:x', 'sha256:y']}},
+                                  {'manifest_digest': {'$in': ['sha256:x', 'sha256:y']}}]}),
+        ]
+        assert sent[0]['criteria']['type_ids'] == ['docker_image']
+
+    def test_copyMany_failed(self, pulp):
+        flexmock(Pulp)
+        Pulp.should_receive('_post').and_return('task1')
+        (Pulp
+            .should_receive('_pollTasks')
+            .and_return({'task1': {'task_id': 'task1', 'state': 'error', 'result': None}}))
+        with pytest.raises(errors.DockPulpError):
+            pulp.copyMany('redhat-foo', ['abc', 'def'], source='redhat-bar')
+
+    def test_remove_many(self, pulp, monkeypatch):
+        monkeypatch.setattr(dockpulp, 'BATCH_SIZE', 2)
+        sent = []
+
+        def fake_post(api, data):
+            assert api == '/pulp/api/v2/repositories/redhat-foo/actions/unassociate/'
+            sent.append(json.loads(data)['criteria'])
+            return 'task%s' % len(sent)
+
+        flexmock(Pulp)
+        Pulp.should_receive('_post').replace_with(fake_post)
+        Pulp.should_receive('watch_tasks').with_args(['task1', 'task2', 'task3', 'task4']).once()
+        pulp.remove('redhat-foo', ['img1', 'sha256:x', 'img2', 'foo@sha256=x/1', 'img3'])
+        assert [(c['type_ids'], c['filters']['unit']) for c in sent] == [
+            (['docker_manifest', 'docker_blob', 'docker_tag', 'docker_manifest_list'],
+             {'$or': [{'digest': {'$in': ['sha256:x']}},
+                      {'manifest_digest': {'$in': ['sha256:x']}}]}),
+            (['iso'], {'name': {'$in': ['foo@sha256=x/1']}}),
+            (['docker_image'], {'image_id': {'$in': ['img1', 'img2']}}),
+            (['docker_image'], {'image_id': {'$in': ['img3']}}),
+        ]
+        assert 'limit' not in sent[0]
+
+    def test_remove_many_failed(self, pulp):
+        flexmock(Pulp)
+        Pulp.should_receive('_post').and_return('task1').and_return('task2')
+        (Pulp
+            .should_receive('_pollTasks')
+            .and_return({'task1': {'task_id': 'task1', 'state': 'finished', 'result': []},
+                         'task2': {'task_id': 'task2', 'state': 'error', 'result': None}}))
+        with pytest.raises(errors.DockPulpError):
+            pulp.remove('redhat-foo', ['img1', 'sha256:x'])
+
+    @pytest.mark.parametrize('change', ['remove', 'remove_many', 'remove_filters', 'deleteRepo'])
+    def test_content_sources_forgotten(self, pulp, change):
+        pulp._content_sources = {('image_id', 'img1'): 'redhat-a',
+                                 ('digest', 'sha256:x'): 'redhat-a',
+                                 ('image_id', 'img2'): 'redhat-b'}
+        flexmock(Pulp)
+        Pulp.should_receive('_post').and_return('task1')
+        Pulp.should_receive('_delete').and_return('task1')
+        Pulp.should_receive('watch')
+        Pulp.should_receive('watch_tasks')
+        if change == 'remove':
+            pulp.remove('redhat-a', 'img1')
+        elif change == 'remove_many':
+            pulp.remove('redhat-a', ['img1', 'sha256:x'])
+        else:
+            getattr(pulp, change)('redhat-a')
+        assert pulp._content_sources == {('image_id', 'img2'): 'redhat-b'}
+
+    def test_getAncestry(self, pulp):
+        # the repo knows img1 -> img2 -> ext1; ext1 -> ext2 lives elsewhere
+        repo_parents = {'img1': 'img2', 'img2': 'ext1', 'img3': 'img2'}
+        outside = {'ext1': 'ext2', 'ext2': None}
+        searched = []
+
+        def fake_post(api, data):
+            assert api == '/pulp/api/v2/content/units/docker_image/search/'
+            iids = json.loads(data)['criteria']['filters']['image_id']['$in']
+            searched.append(iids)
+            return [{'image_id': i, 'parent_id': outside[i]} for i in iids if i in outside]
+
+        flexmock(Pulp).should_receive('_post').replace_with(fake_post)
+        ancestry = pulp.getAncestry(['img1', 'img3', 'gone'], parents=repo_parents)
+        assert ancestry == {'img1': ['img2', 'ext1', 'ext2'],
+                            'img3': ['img2', 'ext1', 'ext2'],
+                            'gone': []}
+        assert searched == [['ext1', 'gone'], ['ext2']]
+
+    def test_getImageParents(self, pulp):
+        units = [{'metadata': {'image_id': 'img1', 'parent_id': 'img2'}},
+                 {'metadata': {'image_id': 'img2'}}]
+        (flexmock(Pulp)
+            .should_receive('_post')
+            .with_args('/pulp/api/v2/repositories/redhat-foo/search/units/', data=str)
+            .and_return(units)
+            .once())
+        assert pulp.getImageParents('redhat-foo') == {'img1': 'img2', 'img2': None}
+
+    @pytest.mark.parametrize('manifests', [False, True])
+    def test_getGarbagePlan(self, pulp, manifests):
+        repos = [{'id': 'redhat-foo', 'scratchpad': {'tags': [{'tag': 'v1', 'image_id': 'img1'}]}},
+                 {'id': 'redhat-everything', 'scratchpad': {}}]
+        units = {
+            'redhat-foo': [
+                {'unit_type_id': 'docker_image', 'metadata': {'image_id': 'img1',
+                                                              'parent_id': 'img2'}},
+                {'unit_type_id': 'docker_tag', 'metadata': {'manifest_digest': 'sha256:list'}},
+                {'unit_type_id': 'docker_manifest_list',
+                 'metadata': {'digest': 'sha256:list', 'manifests': [{'digest': 'sha256:m1'}]}},
+                {'unit_type_id': 'docker_manifest',
+                 'metadata': {'digest': 'sha256:m1', 'config_layer': 'sha256:c1',
+                              'fs_layers': [{'blob_sum': 'sha256:b1'}]}},
+                {'unit_type_id': 'docker_blob', 'metadata': {'digest': 'sha256:b1'}},
+                {'unit_type_id': 'docker_blob', 'metadata': {'digest': 'sha256:c1'}},
+                {'unit_type_id': 'docker_blob', 'metadata': {'digest': 'sha256:stale'}},
+            ],
+            'redhat-everything': [
+                {'unit_type_id': 'docker_image', 'metadata': {'image_id': 'img2'}},
+                {'unit_type_id': 'docker_image', 'metadata': {'image_id': 'img3'}},
+                {'unit_type_id': 'docker_manifest',
+                 'metadata': {'digest': 'sha256:m2', 'fs_layers': [{'blob_sum': 'sha256:b2'}]}},
+                {'unit_type_id': 'docker_blob', 'metadata': {'digest': 'sha256:b1'}},
+                {'unit_type_id': 'docker_blob', 'metadata': {'digest': 'sha256:b2'}},
+            ],
+        }
+
+        def fake_post(api, data):
+            if api == '/pulp/api/v2/repositories/search/':
+                return repos
+            criteria = json.loads(data)['criteria']
+            assert criteria['fields']['unit']
+            # paginated like _collect_repo_units expects
+            repo_units = [dict(unit, unit_id=str(i))
+                          for i, unit in enumerate(units[api.split('/')[5]])]
+            return repo_units[criteria['skip']:criteria['skip'] + criteria['limit']]
+
+        flexmock(Pulp).should_receive('_post').replace_with(fake_post)
+        if manifests:
+            expected = {'redhat-foo': ['sha256:stale'],
+                        'redhat-everything': ['img3', 'sha256:b2', 'sha256:m2']}
+        else:
+            # the untagged manifest m2 is kept, and so is its blob
+            expected = {'redhat-foo': ['sha256:stale'],
+                        'redhat-everything': ['img3']}
+        assert pulp.getGarbagePlan(workers=2, manifests=manifests) == expected
+
+    def test_collectGarbage(self, pulp):
+        plan = {'redhat-foo': ['sha256:x'], 'redhat-bar': ['img1']}
+        future_bar = TaskFuture(pulp, ['task1'])
+        future_foo = TaskFuture(pulp, ['task2'])
+        flexmock(Pulp)
+        (Pulp
+            .should_receive('remove')
+            .with_args('redhat-bar', ['img1'], future=True)
+            .and_return(future_bar)
+            .once())
+        (Pulp
+            .should_receive('remove')
+            .with_args('redhat-foo', ['sha256:x'], future=True)
+            .and_return(future_foo)
+            .once())
+        Pulp.should_receive('watch_futures').with_args([future_bar, future_foo]).once()
+        deleted = []
+
+        def fake_delete(api):
+            deleted.append(api.split('/')[6])
+            return 'task%s' % (len(deleted) + 2)
+
+        Pulp.should_receive('_delete').replace_with(fake_delete)
+        Pulp.should_receive('watch_tasks').with_args(['task3', 'task4']).once()
+        pulp.collectGarbage(plan)
+        # manifests are left alone unless asked for
+        assert deleted == ['docker_image', 'docker_blob']
+
+    @pytest.mark.parametrize('method,api,field', [
+        ('getImageIdsExist', '/pulp/api/v2/content/units/docker_image/search/', 'image_id'),
+        ('getRepos', '/pulp/api/v2/repositories/search/', 'id'),
+        ('getTasks', '/pulp/api/v2/tasks/search/', 'task_id'),
+    ])
+    def test_search_in_batches(self, pulp, monkeypatch, method, api, field):
+        monkeypatch.setattr(dockpulp, 'BATCH_SIZE', 2)
+        searched = []
+        lock = threading.Lock()
+
+        def fake_post(url, data):
+            assert url == api
+            values = json.loads(data)['criteria']['filters'][field]['$in']
+            with lock:
+                searched.append(values)
+            return [{field: value, 'image_id': value} for value in values]
+
+        flexmock(Pulp).should_receive('_post').replace_with(fake_post)
+        result = getattr(pulp, method)(['a', 'b', 'c', 'd', 'e'])
+        assert sorted(searched) == [['a', 'b'], ['c', 'd'], ['e']]
+        if method == 'getImageIdsExist':
+            assert result == ['a', 'b', 'c', 'd', 'e']
+        else:
+            assert [r[field] for r in result] == ['a', 'b', 'c', 'd', 'e']
+
+    def test_find_content_sources(self, pulp):
+        units = {
+            'docker_manifest': [{'digest': 'sha256:a', 'repository_memberships': ['redhat-a']}],
+            'docker_manifest_list': [],
+            'docker_blob': [{'digest': 'sha256:b',
+                             'repository_memberships': ['redhat-b', 'redhat-c']}],
+        }
+        searched = []
+
+        def fake_post(api, data):
+            content_type = api.split('/')[6]
+            searched.append((content_type, json.loads(data)['criteria']['filters']))
+            return units[content_type]
+
+        flexmock(Pulp).should_receive('_post').replace_with(fake_post)
+        types = ['docker_manifest', 'docker_manifest_list', 'docker_blob']
+        assert pulp._find_content_sources(['sha256:a', 'sha256:b'], 'digest', types) == {
+            'sha256:a': 'redhat-a', 'sha256:b': 'redhat-b'}
+        assert searched == [
+            ('docker_manifest', {'digest': {'$in': ['sha256:a', 'sha256:b']}}),
+            ('docker_manifest_list', {'digest': {'$in': ['sha256:b']}}),
+            ('docker_blob', {'digest': {'$in': ['sha256:b']}}),
+        ]
+        # remembered for the session
+        assert pulp._find_content_source('sha256:b', 'digest', types) == 'redhat-b'
+        assert len(searched) == 3
+        with pytest.raises(errors.DockPulpError):
+            pulp._find_content_sources(['sha256:a', 'sha256:c'], 'digest', types)
+        assert searched[-1] == ('docker_blob', {'digest': {'$in': ['sha256:c']}})
+
+    def test_updateTags(self, pulp):
+        existing = [{'image_id': 'img1', 'tag': 'a'}, {'image_id': 'img2', 'tag': 'c'},
+                    {'image_id': 'img2', 'tag': 'latest'}, {'image_id': 'img3', 'tag': 'd'}]
+        flexmock(Pulp)
+        Pulp.should_receive('_getTags').with_args('redhat-foo').once().and_return(existing)
+        sent = {}
+
+        def fake_put(api, data):
+            assert api == '/pulp/api/v2/repositories/redhat-foo/'
+            sent.update(json.loads(data))
+            return 'tid'
+
+        Pulp.should_receive('_put').replace_with(fake_put)
+        Pulp.should_receive('watch').with_args('tid').once()
+        pulp.updateTags('redhat-foo', {'img1': ['latest', 'x'], 'img2': []})
+        scratchpad = sent['delta']['scratchpad']
+        assert scratchpad['tags'] == [{'image_id': 'img3', 'tag': 'd'},
+                                      {'image_id': 'img1', 'tag': 'latest'},
+                                      {'image_id': 'img1', 'tag': 'x'}]
+        assert 'tags_updated' in scratchpad
+
+    def test_remove_future(self, pulp):
+        flexmock(RequestsHttpCaller)
+        (RequestsHttpCaller
+            .should_receive('__call__')
+            .with_args('post', '/pulp/api/v2/repositories/testrepo/actions/unassociate/',
+                       data=str)
+            .and_return('t1')
+            .and_return('t2'))
+        flexmock(Pulp)
+        Pulp.should_receive('watch').never()
+        futures = [pulp.remove('testrepo', img, future=True) for img in ('a', 'b')]
+        assert [f.task_id for f in futures] == ['t1', 't2']
+        reports = [{'task_id': 't1', 'state': 'finished', 'result': []},
+                   {'task_id': 't2', 'state': 'finished', 'result': []}]
+        (Pulp
+            .should_receive('watch_tasks')
+            .with_args(['t1', 't2'], timeout=None)
+            .once()
+            .and_return(reports))
+        assert pulp.watch_futures(futures) == futures
+        assert [f.result() for f in futures] == [[reports[0]], [reports[1]]]
+        assert all(f.done() for f in futures)
+
+    @pytest.mark.parametrize('concurrency', [1, 2])
+    def test_crane(self, pulp, concurrency):
+        repos = ['redhat-a', 'redhat-b', 'redhat-c']
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+        posted = []
+
+        def fake_post(api, data):
+            repo = api.split('/')[5]
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+                posted.append((repo, json.loads(data)['id']))
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return '%s-%s' % (repo, json.loads(data)['id'])
+
+        watched = []
+        flexmock(Pulp)
+        Pulp.should_receive('_post').replace_with(fake_post)
+        Pulp.should_receive('watch_tasks').replace_with(watched.extend)
+        tasks = pulp.crane(repos, force_refresh=True, concurrency=concurrency)
+        dists = ['docker_web_distributor_name_cli', 'docker_rsync_distributor']
+        assert tasks == ['%s-%s' % (repo, dist) for repo in repos for dist in dists]
+        assert sorted(watched) == sorted(tasks)
+        assert state['most'] == concurrency
+        for repo in repos:
+            # release order is kept within each repo
+            assert [d for r, d in posted if r == repo] == dists
+        # the shared distributor config is left alone
+        assert 'override_config' not in pulp.distributorconf['foo']
+
+    @pytest.mark.parametrize('report', [
+        {'state': 'error', 'error': 'publish failed', 'traceback': None},
+        # finished, but the distributor says it did not publish
+        {'state': 'finished', 'result': {'success_flag': False}},
+    ])
+    def test_crane_failed_publish(self, pulp, report):
+        report = dict(report, task_id='t1')
+        posted = []
+
+        def fake_post(api, data):
+            posted.append(json.loads(data)['id'])
+            return 't%s' % len(posted)
+
+        flexmock(Pulp)
+        Pulp.should_receive('_post').replace_with(fake_post)
+        (Pulp
+            .should_receive('getTask')
+            .with_args('t1')
+            .and_return(report))
+        with pytest.raises(errors.DockPulpError):
+            pulp.crane(repos=['redhat-foo'])
+        # the next distributor in release order is not published
+        assert posted == ['docker_web_distributor_name_cli']
+
+    @pytest.mark.parametrize('failed', ['t1', 't2'])
+    def test_watch_tasks_failed(self, pulp, failed):
+        reports = dict((tid, {'task_id': tid, 'state': 'finished', 'result': []})
+                       for tid in ('t1', 't2'))
+        reports[failed] = {'task_id': failed, 'state': 'error', 'result': None}
+        flexmock(Pulp)
+        # t1 ends first, t2 is the last task to end
+        (Pulp
+            .should_receive('_pollTasks')
+            .and_return({'t1': reports['t1']})
+            .and_return({'t2': reports['t2']}))
+        flexmock(time).should_receive('sleep')
+        Pulp.should_receive('deleteTask').with_args('t2').times(1 if failed == 't1' else 0)
+        with pytest.raises(errors.DockPulpError):
+            pulp.watch_tasks(['t1', 't2'], poll=1)
+
+    def test_throttle(self, pulp):
+        pulp.queue_target = 4
+        workers = [{'name': 'reserved_resource_worker-%s@host' % i} for i in range(2)]
+        workers.append({'name': 'resource_manager@host'})
+        flexmock(Pulp)
+        Pulp.should_receive('getWorkers').and_return(workers)
+        # full at first, then drained
+        Pulp.should_receive('getQueueDepth').and_return(8).and_return(3).twice()
+        slept = []
+        flexmock(time).should_receive('sleep').replace_with(slept.append)
+        throttle = pulp.throttle()
+        assert throttle is pulp.throttle()
+        throttle.refresh = 0
+        throttle.admit()
+        assert throttle.limit == 8
+        assert len(slept) == 1
+        assert throttle.depth == 3
+        # admitted tasks count against the limit until the next measurement
+        throttle.refresh = 60
+        for i in range(4):
+            throttle.admit()
+        assert throttle.admitted == 5
+        assert len(slept) == 1
+
+    def test_throttle_disabled(self, pulp):
+        assert pulp.throttle() is None
+
+    def test_getStaleRepoIDs(self, pulp):
+        def dists(web, rsync):
+            return [{'id': 'docker_web_distributor_name_cli', 'last_publish': web},
+                    {'id': 'docker_rsync_distributor', 'last_publish': rsync}]
+
+        blobs = [
+            {'id': 'redhat-everything', 'distributors': []},
+            {'id': 'redhat-old', 'last_unit_added': '2020-01-01T00:00:00Z',
+             'last_unit_removed': None, 'scratchpad': {},
+             'distributors': dists('2020-02-01T00:00:00Z', '2020-02-01T00:00:00+00:00')},
+            {'id': 'redhat-added', 'last_unit_added': '2020-03-01T00:00:00.123Z',
+             'last_unit_removed': None, 'scratchpad': {},
+             'distributors': dists('2020-02-01T00:00:00Z', '2020-02-01T00:00:00Z')},
+            {'id': 'redhat-tagged', 'last_unit_added': '2020-01-01T00:00:00Z',
+             'last_unit_removed': None, 'scratchpad': {'tags_updated': '2020-03-01T00:00:00Z'},
+             'distributors': dists('2020-02-01T00:00:00Z', '2020-02-01T00:00:00Z')},
+            {'id': 'redhat-unpublished', 'scratchpad': {},
+             'distributors': dists('2020-02-01T00:00:00Z', None)},
+            # tagged by a client whose clock is 30 seconds behind the server
+            {'id': 'redhat-skewed', 'last_unit_added': '2020-01-01T00:00:00Z',
+             'last_unit_removed': None, 'scratchpad': {'tags_updated': '2020-01-31T23:59:30Z'},
+             'distributors': dists('2020-02-01T00:00:00Z', '2020-02-01T00:00:00Z')},
+            {'id': 'redhat-retagged', 'last_unit_added': '2020-01-01T00:00:00Z',
+             'last_unit_removed': None, 'scratchpad': {'tags_updated': '2020-01-31T23:00:00Z'},
+             'distributors': dists('2020-02-01T00:00:00Z', '2020-02-01T00:00:00Z')},
+            {'id': 'redhat-same-second', 'last_unit_added': '2020-02-01T00:00:00Z',
+             'last_unit_removed': None, 'scratchpad': {},
+             'distributors': dists('2020-02-01T00:00:00Z', '2020-02-01T00:00:00Z')},
+        ]
+        sent = {}
+
+        def fake_post(api, data):
+            assert api == '/pulp/api/v2/repositories/search/'
+            sent.update(json.loads(data))
+            return blobs
+
+        flexmock(Pulp).should_receive('_post').replace_with(fake_post)
+        assert pulp.clock_skew == 60
+        assert pulp.getStaleRepoIDs(['redhat-old', 'redhat-added']) == [
+            'redhat-added', 'redhat-same-second', 'redhat-skewed', 'redhat-tagged',
+            'redhat-unpublished']
+        assert sent['distributors'] is True
+        assert sent['criteria']['filters'] == {'id': {'$in': ['redhat-old', 'redhat-added']}}
+
+    @pytest.mark.parametrize('state', ['finished', 'error'])
+    def test_task_future_result(self, pulp, state):
+        task = {'task_id': 't1', 'state': state, 'traceback': None, 'error': 'failed'}
+        flexmock(Pulp)
+        # once for done(), once when result() watches it
+        Pulp.should_receive('getTask').with_args('t1').and_return(task).twice()
+        future = TaskFuture(pulp, ['t1'])
+        assert future.done()
+        Pulp.should_call('watch').with_args('t1', timeout=None).once()
+        if state == 'finished':
+            assert future.result() == [task]
+            assert future.result() == [task]
+        else:
+            for i in range(2):
+                with pytest.raises(errors.DockPulpTaskError):
+                    future.result()
+
+    def test_watch_futures_failed(self, pulp):
+        futures = [TaskFuture(pulp, ['t1']), TaskFuture(pulp, ['t2'])]
+        # a publish that ended "finished" but reports a failure
+        reports = [{'task_id': 't1', 'state': 'finished', 'result': []},
+                   {'task_id': 't2', 'state': 'finished', 'result': {'success_flag': False}}]
+        flexmock(Pulp)
+        Pulp.should_receive('watch_tasks').and_return(reports).once()
+        with pytest.raises(errors.DockPulpTaskError):
+            pulp.watch_futures(futures)
+        assert futures[0].result() == [reports[0]]
+        with pytest.raises(errors.DockPulpTaskError):
+            futures[1].result()
+
     def test_remove_filters(self, pulp):
         repo = 'foobar'
         type_ids = ['docker_image', 'docker_manifest', 'docker_blob', 'docker_tag',
@@ -1025,11 +1576,13 @@ class TestPulp(object):
         if filters is None:
             pulp.should_receive('copy_filters').never()
         else:
+            future = TaskFuture(pulp, ['123'])
             (pulp
              .should_receive('copy_filters')
-             .with_args(origin_repo, 'redhat-foobar', filters)
+             .with_args(origin_repo, 'redhat-foobar', filters, future=True)
              .once()
-             .and_return(None))
+             .and_return(future))
+            pulp.should_receive('watch_futures').with_args([future]).once()
 
         (new_imgs,
          new_manifests,
@@ -1039,6 +1592,314 @@ class TestPulp(object):
         assert list(manifests) == new_manifests
         assert list(manifest_lists) == new_manifest_lists
 
+    @pytest.mark.parametrize('present', [[], ['base'], ['base', 'top']])
+    def test_upload(self, pulp, tmpdir, present):
+        image = str(tmpdir.join('image.tar'))
+        write_image(image, [('base', None), ('top', 'base')])
+        flexmock(Pulp)
+        (Pulp
+            .should_receive('getImageIdsExist')
+            .once()
+            .and_return(present))
+        pulp_filter = {'unit': {'$or': [{'image_id': 'base'}, {'image_id': 'top'}]}}
+        if len(present) == 2:
+            Pulp.should_receive('_upload').never()
+            (Pulp
+                .should_receive('_find_content_source')
+                .with_args('top', 'image_id', ['docker_image'])
+                .once()
+                .and_return('redhat-other'))
+            Pulp.should_receive('createOriginRepo').with_args('redhat-foo').once()
+            (Pulp
+                .should_receive('copy_filters')
+                .with_args('origin-redhat-foo', source='redhat-other', filters=pulp_filter,
+                           v1=True, v2=False)
+                .once()
+                .ordered())
+        else:
+            (Pulp
+                .should_receive('_upload')
+                .with_args(object, os.path.getsize(image), 'top', 'image.tar', 'redhat-foo',
+                           'origin-redhat-foo', validation=None)
+                .once())
+        (Pulp
+            .should_receive('copy_filters')
+            .with_args('redhat-foo', source='origin-redhat-foo', filters=pulp_filter,
+                       v1=True, v2=False)
+            .once()
+            .ordered())
+        pulp.upload(image, 'redhat-foo')
+
+    def test_upload_reduced(self, pulp, tmpdir):
+        image = str(tmpdir.join('image.tar'))
+        write_image(image, [('base', None), ('top', 'base')])
+        sent = {}
+
+        def fake_upload(fobj, size, iid, filename, drepo, origin_drepo, validation=None):
+            sent['names'] = tarfile.open(fileobj=fobj).getnames()
+            sent['size'] = size
+
+        flexmock(Pulp)
+        Pulp.should_receive('getImageIdsExist').and_return(['base'])
+        Pulp.should_receive('_upload').replace_with(fake_upload).once()
+        Pulp.should_receive('copy_filters').once()
+        pulp.upload(image, 'redhat-foo', reduce_layers=True)
+        assert 'base/layer.tar' not in sent['names']
+        assert set(['base/json', 'top/json', 'top/layer.tar']) <= set(sent['names'])
+        assert sent['size'] > 0
+
+    @pytest.mark.parametrize('valid', [True, False])
+    def test_upload_stream(self, pulp, tmpdir, valid):
+        image = str(tmpdir.join('image.tar'))
+        write_image(image, [('base', None), ('top', 'base')])
+        pulp.chunk_size = 1
+
+        def validate(inspector):
+            assert inspector.check_repo() == 0
+            if not valid:
+                raise SystemExit(4)
+
+        flexmock(Pulp)
+        Pulp.should_receive('_createUploadRequest').and_return('rid').once()
+        (Pulp
+            .should_receive('_put')
+            .with_args('/pulp/api/v2/content/uploads/rid/0/', data=object)
+            .once())
+        if valid:
+            (Pulp
+                .should_receive('_importUpload')
+                .with_args('rid', os.path.getsize(image), 'top', 'image.tar', 'redhat-foo',
+                           'origin-redhat-foo')
+                .once())
+            Pulp.should_receive('_deleteUploadRequest').never()
+            Pulp.should_receive('copy_filters').once()
+        else:
+            Pulp.should_receive('_importUpload').never()
+            Pulp.should_receive('_deleteUploadRequest').with_args('rid').once()
+        with open(image, 'rb') as fobj:
+            if valid:
+                pulp.upload_stream(fobj, 'redhat-foo', validate=validate)
+            else:
+                with pytest.raises(SystemExit):
+                    pulp.upload_stream(fobj, 'redhat-foo', validate=validate)
+
+    @pytest.mark.parametrize('valid', [True, False])
+    def test_upload_validate(self, pulp, tmpdir, valid):
+        image = str(tmpdir.join('image.tar'))
+        write_image(image, [('base', None), ('top', 'base')])
+        checked = []
+
+        def validate(path):
+            checked.append((path, threading.current_thread().name))
+            if not valid:
+                raise ValueError('bad image')
+
+        flexmock(Pulp)
+        Pulp.should_receive('getImageIdsExist').and_return([])
+        Pulp.should_receive('_createUploadRequest').and_return('rid').once()
+        Pulp.should_receive('_put').with_args('/pulp/api/v2/content/uploads/rid/0/', data=object)
+        if valid:
+            (Pulp
+                .should_receive('_importUpload')
+                .with_args('rid', os.path.getsize(image), 'top', 'image.tar', 'redhat-foo',
+                           'origin-redhat-foo')
+                .once())
+            Pulp.should_receive('_deleteUploadRequest').never()
+            Pulp.should_receive('copy_filters').once()
+            pulp.upload(image, 'redhat-foo', validate=validate)
+        else:
+            Pulp.should_receive('_importUpload').never()
+            Pulp.should_receive('_deleteUploadRequest').with_args('rid').once()
+            Pulp.should_receive('copy_filters').never()
+            with pytest.raises(ValueError):
+                pulp.upload(image, 'redhat-foo', validate=validate)
+        assert checked[0][0] == image
+        assert checked[0][1] != threading.current_thread().name
+
+    def test_upload_xz(self, pulp, tmpdir):
+        image = str(tmpdir.join('image.tar'))
+        write_image(image, [('base', None)])
+        xz_image = str(tmpdir.join('image.tar.xz'))
+        with tarfile.open(image) as src:
+            with tarfile.open(xz_image, mode='w:xz') as dst:
+                for member in src:
+                    dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+        flexmock(Pulp)
+        Pulp.should_receive('getImageIdsExist').and_return([])
+        Pulp.should_receive('_createUploadRequest').and_return('rid').once()
+        sent = []
+        Pulp.should_receive('_put').replace_with(lambda api, data: sent.append(data))
+        (Pulp
+            .should_receive('_importUpload')
+            .with_args('rid', int, 'base', 'image.tar.gz', 'redhat-foo', 'origin-redhat-foo')
+            .once())
+        Pulp.should_receive('copy_filters').once()
+        pulp.upload(xz_image, 'redhat-foo')
+        with tarfile.open(fileobj=BytesIO(b''.join(sent)), mode='r:gz') as t:
+            assert 'base/layer.tar' in t.getnames()
+
+    def test_upload_xz_failed(self, pulp, tmpdir):
+        image = str(tmpdir.join('image.tar'))
+        write_image(image, [('base', None)])
+        xz_image = str(tmpdir.join('image.tar.xz'))
+        with tarfile.open(image) as src:
+            with tarfile.open(xz_image, mode='w:xz') as dst:
+                for member in src:
+                    dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+        flexmock(Pulp)
+        Pulp.should_receive('getImageIdsExist').and_return([])
+        Pulp.should_receive('_createUploadRequest').and_return('rid').once()
+        Pulp.should_receive('_put').and_raise(errors.DockPulpServerError('PUT failed'))
+        Pulp.should_receive('_deleteUploadRequest').with_args('rid').once()
+        Pulp.should_receive('_importUpload').never()
+        # the transcoder threads are stopped before the image file is closed
+        flexmock(dockpulp.imgutils.GzipTranscoder).should_call('close').once()
+        with pytest.raises(errors.DockPulpServerError):
+            pulp.upload(xz_image, 'redhat-foo')
+
+    def test_uploadChunks(self, pulp, tmpdir):
+        image = tmpdir.join('image.tar')
+        content = os.urandom(3 * 1024 * 1024 + 10)
+        image.write_binary(content)
+        pulp.chunk_size = 1
+        sent = []
+        buffers = set()
+
+        def fake_put(api, data):
+            assert isinstance(data, memoryview)
+            buffers.add(id(data.obj))
+            sent.append((api, bytes(data)))
+
+        flexmock(Pulp)
+        Pulp.should_receive('_put').replace_with(fake_put)
+        with open(str(image), 'rb') as fobj:
+            assert pulp._uploadChunks('rid', fobj, len(content)) == len(content)
+        assert [api for api, data in sent] == [
+            '/pulp/api/v2/content/uploads/rid/%s/' % offset
+            for offset in (0, 1048576, 2097152, 3145728)]
+        assert b''.join(data for api, data in sent) == content
+        # every chunk was read into the same buffer
+        assert len(buffers) == 1
+
+    def test_chunkReader_short_reads(self):
+        class Pipe(object):
+            def __init__(self, data):
+                self.data = BytesIO(data)
+
+            def readinto(self, buf):
+                # return at most 3 bytes at a time, like a slow pipe
+                data = self.data.read(min(3, len(buf)))
+                buf[:len(data)] = data
+                return len(data)
+
+        reader = ChunkReader(Pipe(b'0123456789'), 4)
+        chunks = []
+        while True:
+            chunk = reader.read()
+            if not chunk:
+                break
+            chunks.append(bytes(chunk))
+        assert chunks == [b'0123', b'4567', b'89']
+
+    @pytest.mark.parametrize('elapsed, expected', [
+        # fast chunks grow up to the maximum
+        ([0.1, 0.1, 0.1, 0.1], [4, 8, 16, 16]),
+        # slow chunks shrink down to the minimum
+        ([20, 20, 20], [1, 1, 1]),
+        ([5, 0.1, 20, 5], [2, 4, 2, 2]),
+    ])
+    def test_chunkSizer(self, elapsed, expected):
+        sizer = ChunkSizer(2, 1, 16)
+        sizes = []
+        for seconds in elapsed:
+            sizer.update(sizer.size, seconds)
+            sizes.append(sizer.size)
+        assert sizes == expected
+        assert sizer.chunks == len(elapsed)
+        # a short last chunk does not change the size
+        sizer.update(0, 100)
+        assert sizer.size == expected[-1]
+
+    def test_uploadChunks_adaptive(self, pulp, tmpdir):
+        mb = 1024 * 1024
+        image = tmpdir.join('image.tar')
+        content = os.urandom(7 * mb)
+        image.write_binary(content)
+        pulp.chunk_size = 1
+        pulp.chunk_size_max = 4
+        sent = []
+        flexmock(Pulp)
+        Pulp.should_receive('_put').replace_with(
+            lambda api, data: sent.append((api, bytes(data))))
+        with open(str(image), 'rb') as fobj:
+            assert pulp._uploadChunks('rid', fobj) == len(content)
+        # every chunk is sent quickly, so each one doubles up to 4M
+        assert [api for api, data in sent] == [
+            '/pulp/api/v2/content/uploads/rid/%s/' % offset
+            for offset in (0, mb, 3 * mb)]
+        assert b''.join(data for api, data in sent) == content
+
+    @pytest.mark.parametrize('fail', [False, True])
+    def test_upload_many(self, pulp, tmpdir, fail):
+        images = []
+        for name, layers in (('a', [('base', None), ('a', 'base')]),
+                             ('b', [('base', None), ('b', 'base')]),
+                             ('c', [('base', None)]),
+                             ('d', [('old', None)])):
+            images.append(str(tmpdir.join('%s.tar' % name)))
+            write_image(images[-1], layers)
+        flexmock(Pulp)
+        (Pulp
+            .should_receive('getImageIdsExist')
+            .with_args(['a', 'b', 'base', 'old'])
+            .once()
+            .and_return(['old']))
+        Pulp.should_receive('createOriginRepo').with_args('redhat-foo')
+        (Pulp
+            .should_receive('_associatePresent')
+            .with_args('old', ['old'], 'redhat-foo', 'origin-redhat-foo')
+            .once())
+        uploads = {}
+        imported = set()
+
+        def fake_upload_image(image, iid, skip_ids, drepo, origin_drepo, validation=None):
+            if image == images[1]:
+                # the base layer sent with a.tar is imported first
+                assert images[0] in imported
+            uploads[image] = skip_ids
+            if fail and image == images[0]:
+                raise errors.DockPulpError('boom')
+            time.sleep(0.05)
+            imported.add(image)
+
+        Pulp.should_receive('_uploadImage').replace_with(fake_upload_image)
+        if fail:
+            uploaded = ['old']
+        else:
+            uploaded = ['a', 'b', 'base', 'old']
+        (Pulp
+            .should_receive('copy_filters')
+            .with_args('redhat-foo', source='origin-redhat-foo',
+                       filters={'unit': {'$or': [{'image_id': i} for i in uploaded]}},
+                       v1=True, v2=False)
+            .once())
+        results = pulp.upload_many(images, 'redhat-foo')
+        # the shared base layer is only sent with the first tarball
+        if fail:
+            assert uploads == {images[0]: set()}
+        else:
+            assert uploads == {images[0]: set(), images[1]: set(['base'])}
+        assert results[images[0]]['uploaded'] == ['a', 'base']
+        assert results[images[1]]['uploaded'] == ['b']
+        assert results[images[2]]['uploaded'] == []
+        assert results[images[3]] == {'image_id': 'old', 'uploaded': [], 'error': None}
+        if fail:
+            assert results[images[0]]['error'] == 'boom'
+            assert 'base' in results[images[1]]['error']
+            assert 'base' in results[images[2]]['error']
+        else:
+            assert all(r['error'] is None for r in results.values())
+
     @pytest.mark.parametrize('exception,tid,task', [
         (errors.DockPulpTaskError, '111', {'state': 'error', 'traceback': 'fake',
                                            'error': {'code': 'fake'}}),
@@ -1059,6 +1920,203 @@ class TestPulp(object):
             ret = pulp.watch(tid)
             assert ret == task
 
+    @pytest.mark.parametrize('poll, slept', [(None, 0.35), (5, 5)])
+    def test_watch_latency(self, pulp, poll, slept):
+        # a fake Pulp whose task finishes after 0.3 seconds of (virtual) time
+        clock = {'now': 0.0, 'polls': 0}
+
+        def fake_sleep(seconds):
+            clock['now'] += seconds
+
+        def fake_get_task(tid):
+            clock['polls'] += 1
+            return {'state': 'finished' if clock['now'] >= 0.3 else 'running'}
+
+        flexmock(time).should_receive('sleep').replace_with(fake_sleep)
+        flexmock(TaskWatcher).should_receive('_sleep').replace_with(fake_sleep)
+        flexmock(Pulp).should_receive('getTask').replace_with(fake_get_task)
+        pulp.watch('tid', poll=poll)
+        # 0.05 + 0.1 + 0.2 seconds with the default curve
+        assert clock['now'] == pytest.approx(slept)
+        assert clock['polls'] == (4 if poll is None else 2)
+
+    def test_watch_shared(self, pulp):
+        tids = ['t1', 't2', 't3', 't4']
+        searches = []
+
+        def fake_get_tasks(task_ids):
+            searches.append(task_ids)
+            # everything finishes once all four are watched at the same time
+            state = 'finished' if task_ids == tids else 'running'
+            return [{'task_id': tid, 'state': state} for tid in task_ids]
+
+        flexmock(Pulp)
+        Pulp.should_receive('getTask').and_return({'state': 'running'})
+        Pulp.should_receive('getTasks').replace_with(fake_get_tasks)
+        results = {}
+
+        def watch(tid):
+            results[tid] = pulp.watch(tid)
+
+        threads = [threading.Thread(target=watch, args=(tid,)) for tid in tids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == dict((tid, {'task_id': tid, 'state': 'finished'}) for tid in tids)
+        # one search per tick covers every waiter
+        assert searches[-1] == tids
+        assert not pulp.watcher.waiters
+
+    def test_watch_isolated_errors(self, pulp):
+        flexmock(TaskWatcher).should_receive('_sleep')
+        flexmock(Pulp)
+        # the search does not know the bogus task, and getTask fails for it
+        (Pulp
+            .should_receive('getTasks')
+            .replace_with(lambda tids: [{'task_id': tid, 'state': 'finished'}
+                                        for tid in tids if tid != 'bogus']))
+
+        def fake_get_task(tid):
+            if tid == 'bogus':
+                raise errors.DockPulpServerError('404')
+            return {'task_id': tid, 'state': 'finished'}
+
+        Pulp.should_receive('getTask').replace_with(fake_get_task)
+        results = {}
+
+        def watch(tid):
+            try:
+                results[tid] = pulp.watch(tid)
+            except errors.DockPulpError as e:
+                results[tid] = e
+
+        threads = [threading.Thread(target=watch, args=(tid,)) for tid in ('bogus', 't1')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert isinstance(results['bogus'], errors.DockPulpServerError)
+        assert results['t1'] == {'task_id': 't1', 'state': 'finished'}
+
+    @pytest.mark.parametrize('failures', [1, 3])
+    def test_watch_search_retried(self, pulp, failures):
+        flexmock(TaskWatcher).should_receive('_sleep')
+        flexmock(Pulp)
+        calls = {'count': 0}
+
+        def fake_get_tasks(tids):
+            calls['count'] += 1
+            if calls['count'] <= failures:
+                raise errors.DockPulpServerError('503')
+            return [{'task_id': tid, 'state': 'finished', 'result': []} for tid in tids]
+
+        Pulp.should_receive('getTasks').replace_with(fake_get_tasks)
+        if failures < TaskWatcher.max_errors:
+            assert len(pulp.watch_tasks(['t1', 't2'])) == 2
+        else:
+            with pytest.raises(errors.DockPulpServerError):
+                pulp.watch_tasks(['t1', 't2'])
+
+    def test_watch_event_listener(self, pulp):
+        pulp.event_listener = 'http://127.0.0.1:0/events/'
+        # the first poll is far away, only the event can end the wait early
+        pulp.poll_initial = 30
+        state = {'done': False}
+        flexmock(Pulp)
+        Pulp.should_receive('_get').with_args('/pulp/api/v2/events/').and_return([]).once()
+        registered = {}
+
+        def fake_post(api, data):
+            assert api == '/pulp/api/v2/events/'
+            registered.update(json.loads(data))
+            return {'id': 'listener1'}
+
+        Pulp.should_receive('_post').replace_with(fake_post)
+        (Pulp
+            .should_receive('getTask')
+            .with_args('t1')
+            .replace_with(lambda tid: {'state': 'finished' if state['done'] else 'running'}))
+        (Pulp
+            .should_receive('_delete')
+            .with_args('/pulp/api/v2/events/listener1/')
+            .once())
+
+        def finish_task():
+            # wait for the watcher to poll and go to sleep
+            while pulp.events is None or not pulp.watcher.waiters:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            state['done'] = True
+            requests.post(registered['notifier_config']['url'],
+                          data=json.dumps({'event_type': 'repo.publish.finish',
+                                           'call_report': {'task_id': 't1'}}))
+
+        thread = threading.Thread(target=finish_task)
+        thread.start()
+        start = time.time()
+        try:
+            assert pulp.watch('t1')['state'] == 'finished'
+            # without the event the next poll would be event_poll (30s) away
+            assert time.time() - start < 10
+            assert registered['event_types'] == ['repo.sync.finish', 'repo.publish.finish']
+            assert pulp.events.events == 1
+        finally:
+            thread.join()
+            pulp.stopEventListener()
+        assert pulp.events is None
+
+    def test_watch_event_listener_threads(self, pulp):
+        pulp.event_listener = 'http://127.0.0.1:0/events/'
+        flexmock(Pulp)
+        Pulp.should_receive('_get').with_args('/pulp/api/v2/events/').and_return([]).once()
+
+        def fake_post(api, data):
+            # slow enough for the other threads to reach the listener setup
+            time.sleep(0.2)
+            return {'id': 'listener1'}
+
+        Pulp.should_receive('_post').replace_with(fake_post).once()
+        Pulp.should_receive('getTask').replace_with(lambda tid: {'state': 'finished'})
+        Pulp.should_receive('_delete').with_args('/pulp/api/v2/events/listener1/').once()
+        threads = [threading.Thread(target=pulp.watch, args=('t%s' % i,)) for i in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert pulp.event_listener is not None
+            assert pulp.listener_id == 'listener1'
+        finally:
+            pulp.stopEventListener()
+
+    def test_pollIntervals(self, pulp):
+        pulp.poll_max = 1
+        intervals = pulp._pollIntervals()
+        assert [intervals.step() for i in range(7)] == [0.05, 0.1, 0.2, 0.4, 0.8, 1, 1]
+        fixed = pulp._pollIntervals(3)
+        assert [fixed.step() for i in range(3)] == [3, 3, 3]
+        # with events, the curve only goes up further
+        pulp.event_poll = 2
+        pulp.events = object()
+        try:
+            intervals = pulp._pollIntervals()
+            assert [intervals.step() for i in range(7)] == [0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 2]
+        finally:
+            pulp.events = None
+
+    def test_removeEventListeners(self, pulp):
+        url = 'http://builder:8123/events/'
+        listeners = [{'id': 'stale', 'notifier_type_id': 'http',
+                      'notifier_config': {'url': url}},
+                     {'id': 'other', 'notifier_type_id': 'http',
+                      'notifier_config': {'url': 'http://other:8123/events/'}},
+                     {'id': 'mail', 'notifier_type_id': 'email', 'notifier_config': {}}]
+        flexmock(Pulp)
+        Pulp.should_receive('_get').with_args('/pulp/api/v2/events/').and_return(listeners)
+        Pulp.should_receive('_delete').with_args('/pulp/api/v2/events/stale/').once()
+        pulp.removeEventListeners(url)
+
 
 class TestCrane(object):
     # Tests of methods of Crane class.